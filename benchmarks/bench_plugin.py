@@ -0,0 +1,136 @@
+"""
+Headless benchmarks of the plugin hot paths.
+
+    python -m benchmarks.bench_plugin
+    python -m benchmarks.bench_plugin --save benchmarks/baseline.json
+    python -m benchmarks.bench_plugin --compare benchmarks/baseline.json
+
+Needs OctoPrint installed in the same environment.
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+
+import flask
+
+from benchmarks.fakes import make_plugin, device_data
+
+SIZES = (10, 100, 1000)
+
+# metric name -> True when higher is better
+HIGHER_IS_BETTER = dict(
+    messages_per_second=True,
+    state_data_us=False,
+    sidebar_data_us=False,
+    device_save_us=False,
+    pending_timers=False,
+    threads=False,
+)
+
+
+def _per_call_us(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def bench_messages(plugin, mqtt, device_count, rounds=20):
+    messages = 0
+    start = time.perf_counter()
+    for r in range(rounds):
+        payload = b"ON" if r % 2 else b"OFF"
+        for i in range(device_count):
+            mqtt.deliver("tasmota/printer%d/stat/POWER" % i, payload)
+            messages += 1
+        plugin.ingest.drain()
+    return messages / (time.perf_counter() - start)
+
+
+def bench_device_save(plugin, device_count, repeat=50):
+    app = flask.Flask(__name__)
+    dev = device_data(device_count // 2)
+
+    def save():
+        dev['deviceName'] = 'renamed-%f' % time.perf_counter()
+        with app.test_request_context(json=dict(device=dev)):
+            plugin.saveDevice()
+
+    return _per_call_us(save, repeat)
+
+
+def bench_timers(plugin):
+    for dev in plugin.devices:
+        plugin.planStop(dev)
+    res = len(plugin.scheduler), threading.active_count()
+    for dev in plugin.devices:
+        plugin.turnOff(dev)
+    return res
+
+
+def run(sizes=SIZES):
+    results = dict()
+    for size in sizes:
+        plugin, mqtt = make_plugin(size)
+        try:
+            res = dict()
+            res['messages_per_second'] = bench_messages(plugin, mqtt, size)
+            res['state_data_us'] = _per_call_us(plugin.getStateData, 1000)
+            res['sidebar_data_us'] = _per_call_us(plugin.sidebarInfoData, 200)
+            res['device_save_us'] = bench_device_save(plugin, size)
+            res['pending_timers'], res['threads'] = bench_timers(plugin)
+            res['ui_messages'] = len(plugin._plugin_manager.messages)
+            res['mqtt_publishes'] = len(mqtt.published)
+            res['settings_saves'] = plugin._settings.saves
+        finally:
+            plugin.on_shutdown()
+        results[str(size)] = res
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for size, metrics in baseline.items():
+        for name, expected in metrics.items():
+            if name not in HIGHER_IS_BETTER or size not in results or not expected:
+                continue
+            value = results[size][name]
+            if HIGHER_IS_BETTER[name]:
+                regressed = value < expected * (1 - tolerance)
+            else:
+                regressed = value > expected * (1 + tolerance)
+            if regressed:
+                regressions.append("%s devices, %s: %.2f (baseline %.2f)" % (size, name, value, expected))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--save', metavar='FILE', help='store the results as baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results with a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='allowed relative regression (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: %s" % regression, file=sys.stderr)
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
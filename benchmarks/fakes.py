@@ -0,0 +1,210 @@
+"""
+In-process stand-ins for what OctoPrint injects into the plugin, so that
+MqttPlugPlugin can run without a server, a broker or a printer.
+
+OctoPrint itself must still be importable (the plugin mixins come from it).
+"""
+import logging
+import tempfile
+import time
+import uuid
+
+from octoprint_mqtt_plug import MqttPlugPlugin
+from octoprint_mqtt_plug.topics import TopicIndex
+
+BASE_TOPIC = "octoPrint/"
+
+
+class FakeMqtt:
+    """
+    Records publishes and routes ``deliver`` calls to subscribed callbacks.
+    """
+
+    def __init__(self):
+        self.subscriptions = TopicIndex()
+        self.subscribed = []
+        self.unsubscribed = []
+        self.published = []
+        self.connected = True
+
+    def publish(self, topic, payload, retained=False, qos=0, **kwargs):
+        self.published.append((topic, payload, retained, qos))
+        return self.connected
+
+    def subscribe(self, topic, callback, **kwargs):
+        self.subscribed.append(topic)
+        self.subscriptions.add(topic, callback)
+
+    def unsubscribe(self, callback, topic=None):
+        self.unsubscribed.append(topic)
+        self.subscriptions.remove(topic, callback)
+
+    def deliver(self, topic, payload, retain=False):
+        for callback in list(self.subscriptions.match(topic)):
+            callback(topic, payload, retain=retain, qos=0)
+
+    def helpers(self):
+        return dict(
+            mqtt_publish=self.publish,
+            mqtt_subscribe=self.subscribe,
+            mqtt_unsubscribe=self.unsubscribe
+        )
+
+
+class FakeSettings:
+
+    def __init__(self, data=None):
+        self.data = dict(data or dict())
+        self.saves = 0
+
+    def get(self, path, **kwargs):
+        data = self.data
+        for key in path:
+            if type(data) != dict or key not in data:
+                return None
+            data = data[key]
+        return data
+
+    def set(self, path, value, **kwargs):
+        data = self.data
+        for key in path[:-1]:
+            data = data.setdefault(key, dict())
+        data[path[-1]] = value
+
+    def save(self, *args, **kwargs):
+        self.saves += 1
+
+
+class FakePrinter:
+
+    def __init__(self):
+        self.temperatures = dict(
+            tool0=dict(actual=25.0, target=0.0),
+            bed=dict(actual=25.0, target=0.0)
+        )
+        self.history = []
+        self.callbacks = []
+        self.printing = False
+        self.connects = 0
+        self.disconnects = 0
+
+    def get_current_temperatures(self):
+        return self.temperatures
+
+    def get_temperature_history(self):
+        return list(self.history)
+
+    def add_temperature(self, tool0, bed, t=None):
+        self.temperatures = dict(
+            tool0=dict(actual=tool0, target=0.0),
+            bed=dict(actual=bed, target=0.0)
+        )
+        data = dict(self.temperatures, time=t if t is not None else time.time())
+        self.history.append(data)
+        for callback in list(self.callbacks):
+            callback.on_printer_add_temperature(data)
+
+    def register_callback(self, callback):
+        self.callbacks.append(callback)
+
+    def unregister_callback(self, callback):
+        if callback in self.callbacks:
+            self.callbacks.remove(callback)
+
+    def is_printing(self):
+        return self.printing
+
+    def is_pausing(self):
+        return False
+
+    def is_paused(self):
+        return False
+
+    def is_cancelling(self):
+        return False
+
+    def is_operational(self):
+        return True
+
+    def connect(self, *args, **kwargs):
+        self.connects += 1
+
+    def disconnect(self, *args, **kwargs):
+        self.disconnects += 1
+
+
+class _FakePluginInfo:
+
+    def __init__(self, implementation):
+        self.implementation = implementation
+
+
+class _FakeMqttPlugin:
+
+    def __init__(self, base_topic=BASE_TOPIC):
+        self._settings = FakeSettings(dict(publish=dict(baseTopic=base_topic)))
+        self._mqtt_connected = True
+
+
+class FakePluginManager:
+
+    def __init__(self, mqtt: FakeMqtt, base_topic=BASE_TOPIC):
+        self.mqtt = mqtt
+        self.mqttPlugin = _FakeMqttPlugin(base_topic)
+        self.enabled_plugins = dict(mqtt=None)
+        self.plugins = dict(mqtt=_FakePluginInfo(self.mqttPlugin))
+        self.messages = []
+        self.messageBytes = 0
+
+    def get_helpers(self, name, *helpers):
+        if name == "mqtt":
+            return self.mqtt.helpers()
+        return None
+
+    def send_plugin_message(self, identifier, payload):
+        self.messages.append(payload)
+
+
+def device_data(i, state_format="auto"):
+    return dict(
+        id=str(uuid.UUID(int=i + 1)),
+        deviceName="printer-%d" % i,
+        stateTopic="tasmota/printer%d/stat/POWER" % i,
+        switchTopic="tasmota/printer%d/cmnd/POWER" % i,
+        stateFormat=state_format,
+        shutdownType="time",
+        stopDelay=3600,
+        connectionDelay=3600,
+        tags=["farm"] if i % 2 == 0 else [],
+    )
+
+
+def make_plugin(device_count, start_workers=False, base_topic=BASE_TOPIC, **settings):
+    """
+    Build and start a plugin with ``device_count`` devices, ``settings``
+    override the plugin settings (e.g. ``devices``).
+
+    Without ``start_workers`` the ingestion worker is stopped after startup
+    so that benchmarks process the queue themselves with ``ingest.drain()``.
+    """
+    mqtt = FakeMqtt()
+    data = dict(
+        devices=[device_data(i) for i in range(device_count)],
+        cooldownTrigger="event"
+    )
+    data.update(settings)
+
+    plugin = MqttPlugPlugin()
+    plugin._identifier = "mqtt_plug"
+    plugin._plugin_version = "bench"
+    plugin._logger = logging.getLogger("octoprint.plugins.mqtt_plug")
+    plugin._settings = FakeSettings(data)
+    plugin._printer = FakePrinter()
+    plugin._plugin_manager = FakePluginManager(mqtt, base_topic)
+    plugin._data_folder = tempfile.mkdtemp(prefix="mqtt_plug_bench")
+    plugin.on_after_startup()
+
+    if not start_workers:
+        plugin.ingest.stop()
+
+    return plugin, mqtt
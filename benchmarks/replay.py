@@ -0,0 +1,106 @@
+"""
+Replay MQTT traffic recorded by the plugin (``recordTraffic`` setting,
+``traffic.jsonl`` in the plugin data folder) through ``on_mqtt_sub``.
+
+    python -m benchmarks.replay traffic.jsonl            # recorded pace
+    python -m benchmarks.replay traffic.jsonl --speed 10
+    python -m benchmarks.replay traffic.jsonl --max
+
+The plugin runs against the fakes of ``fakes.py`` with the devices and base
+topic found in the recording headers. Needs OctoPrint installed in the same
+environment.
+"""
+import argparse
+import json
+import sys
+import time
+
+from benchmarks.fakes import make_plugin
+from octoprint_mqtt_plug.recorder import decode_line
+
+
+def read(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield decode_line(line)
+
+
+def replay(path, speed=1.0):
+    """
+    Replay ``path``, ``speed`` of None meaning as fast as possible.
+    """
+    records = read(path)
+    header = None
+    for kind, data in records:
+        if kind == "header":
+            header = data
+            break
+    if header is None:
+        raise ValueError("%s has no header line" % path)
+
+    plugin, mqtt = make_plugin(0, start_workers=True, base_topic=header.get('baseTopic'),
+                               devices=header.get('devices') or [])
+    messages = 0
+    try:
+        start = time.perf_counter()
+        # pace relative to the first message of each recording session, the
+        # downtime between sessions is skipped
+        first = paceStart = None
+        for kind, data in records:
+            if kind == "header":
+                # a later recording session, devices may have been edited
+                for dev in data.get('devices') or []:
+                    plugin.upsertDevice(dev)
+                first = None
+                continue
+
+            t, topic, payload, retain = data
+            if speed is not None:
+                if first is None:
+                    first, paceStart = t, time.perf_counter()
+                delay = (t - first) / speed - (time.perf_counter() - paceStart)
+                if delay > 0:
+                    time.sleep(delay)
+            plugin.on_mqtt_sub(topic, payload, retain=retain)
+            messages += 1
+
+        # let the worker finish, then process what is left
+        plugin.ingest.stop()
+        plugin.ingest.drain()
+        elapsed = time.perf_counter() - start
+
+        ingest = plugin.ingest.stats()
+        return dict(
+            messages=messages,
+            seconds=elapsed,
+            messages_per_second=messages / elapsed if elapsed else None,
+            batches=ingest['batches'],
+            superseded=ingest['superseded'],
+            overflow=ingest['overflow'],
+            ui_pushes=len(plugin._plugin_manager.messages),
+            mqtt_publishes=len(mqtt.published),
+            devices=len(plugin.devices),
+        )
+    finally:
+        plugin.on_shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('file', help='recorded traffic (JSON lines)')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--speed', type=float, default=1.0, help='replay speed factor (default: %(default)s)')
+    group.add_argument('--max', action='store_true', help='replay as fast as possible')
+    args = parser.parse_args(argv)
+
+    if not args.max and args.speed <= 0:
+        parser.error("--speed must be positive")
+
+    results = replay(args.file, None if args.max else args.speed)
+    print(json.dumps(results, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
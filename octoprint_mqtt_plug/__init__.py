@@ -2,8 +2,11 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import concurrent.futures
+import contextlib
+import itertools
 import json
 import math
+import os
 import threading
 import time
 import uuid
@@ -13,50 +16,103 @@ import octoprint.plugin
 from flask_babel import gettext
 from octoprint.access import ADMIN_GROUP
 
-from octoprint_mqtt_plug.device import Device
+from octoprint_mqtt_plug import metrics
+from octoprint_mqtt_plug.commands import CommandTracker
+from octoprint_mqtt_plug.cooldown import CooldownEstimator, CooldownWatcher, is_cooled_down, next_check_delay
+from octoprint_mqtt_plug.device import Device, validateData
+from octoprint_mqtt_plug.ingest import MessageIngest
+from octoprint_mqtt_plug.jobs import Job, JobRegistry
+from octoprint_mqtt_plug.laststate import LastStateFile
+from octoprint_mqtt_plug.persister import SettingsPersister
+from octoprint_mqtt_plug.publisher import Publisher
+from octoprint_mqtt_plug.recorder import TrafficRecorder
+from octoprint_mqtt_plug.registry import DeviceRegistry
+from octoprint_mqtt_plug.schedule import ScheduleStore
+from octoprint_mqtt_plug.scheduler import Scheduler
+from octoprint_mqtt_plug.state import StateStore
+from octoprint_mqtt_plug.subscriptions import SubscriptionManager
+from octoprint_mqtt_plug.sync import MessageLog
+from octoprint_mqtt_plug.telemetry import TelemetryStore
+from octoprint_mqtt_plug.topics import TopicIndex
 
 class MqttPlugPlugin(
     octoprint.plugin.EventHandlerPlugin,
     octoprint.plugin.SimpleApiPlugin,
     octoprint.plugin.StartupPlugin,
+    octoprint.plugin.ShutdownPlugin,
     octoprint.plugin.SettingsPlugin,
     octoprint.plugin.AssetPlugin,
     octoprint.plugin.TemplatePlugin,
     octoprint.plugin.WizardPlugin,
     octoprint.plugin.BlueprintPlugin):
-    shutdownAt = dict()
-    stopTimer = dict()
-    stopCooldown = dict()
-    pool = concurrent.futures.ThreadPoolExecutor()
     baseTopic = None
+    mqttPlugin = None
 
-    devices: [Device] = []
+    devices: DeviceRegistry
 
     def __init__(self):
         super().__init__()
         self.mqtt_publish = lambda *args, **kwargs: None
         self.mqtt_subscribe = lambda *args, **kwargs: None
         self.mqtt_unsubscribe = lambda *args, **kwargs: None
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="mqtt_plug")
+        self.scheduler = Scheduler(self.pool)
+        self.persister = SettingsPersister(self.scheduler, self.save_settings)
+        self.jobs = JobRegistry()
+        # every publish goes through the helper set in on_after_startup
+        self.publisher = Publisher(self.scheduler, lambda *args, **kwargs: self.mqtt_publish(*args, **kwargs),
+                                   self.isMqttConnected)
+        self.commands = CommandTracker(self.scheduler, self.publishSwitch, self.on_command_pending)
+        self.pendingBatch = threading.local()
+        self.devices = DeviceRegistry()
+        # validators must not survive a restart
+        self.bootId = uuid.uuid4().hex[:8]
+        self.messageLog = MessageLog(self.bootId)
+        self.schedules = ScheduleStore()
+        self.fleetLock = threading.Lock()
+        self.fleetCache = None
+        self.fleetBuilds = 0
+
+        metrics.ACTIVE_TIMERS.fn = self.countActiveTimers
+        metrics.SCHEDULED_TASKS.fn = lambda: len(self.scheduler)
+        metrics.INGEST_DEPTH.fn = lambda: self.ingest.depth
+        metrics.INGEST_DROPPED.fn = lambda: self.ingest.dropped
+        metrics.PUBLISH_BUFFER.fn = lambda: self.publisher.buffered
+        self.states = StateStore()
+        self.lastStates = None
+        self.statePersister = SettingsPersister(self.scheduler, self.save_last_states, delay=2.0, max_delay=10.0,
+                                                name="last states")
+        self.stateTopics = TopicIndex()
+        self.telemetryTopics = TopicIndex()
+        self.telemetry = TelemetryStore()
+        self.subscriptions = SubscriptionManager(
+            lambda topic: self.mqtt_subscribe(topic, self.on_mqtt_sub),
+            lambda topic: self.mqtt_unsubscribe(self.on_mqtt_sub, topic=topic))
+        self.controlTopics = dict()
+        self.controlSequence = itertools.count()
+        self.ingest = MessageIngest(self.on_mqtt_batch)
+        self.cooldownWatcher = None
+        self.recorder = None
 
     def write_devices_in_settings(self):
         devices = self.get_serialized_devices()
         self._settings.set(['devices'], devices)
 
     def get_serialized_devices(self):
-        settingsDevices = []
-        for dev in self.devices:
-            if dev.id is not None:
-                settingsDevices.append(dev.serialize())
-
-        return settingsDevices
+        return self.devices.serialize()
 
     def save_settings(self):
 
         self.write_devices_in_settings()
 
         self._settings.save()
+        metrics.SETTINGS_SAVES.inc()
         self._logger.debug('Settings saved')
 
+    def save_last_states(self):
+        if self.lastStates is not None:
+            self.lastStates.write(self.states.snapshot())
+
     def on_after_startup(self):
 
         helpers = self._plugin_manager.get_helpers("mqtt", "mqtt_publish", "mqtt_subscribe", "mqtt_unsubscribe")
@@ -71,78 +127,181 @@ class MqttPlugPlugin(
             if 'mqtt' in self._plugin_manager.enabled_plugins:
                 mqttPlugin = self._plugin_manager.plugins['mqtt'].implementation
                 if mqttPlugin:
+                    self.mqttPlugin = mqttPlugin
                     self.baseTopic = mqttPlugin._settings.get(['publish', 'baseTopic'])
 
+        self.publisher.qos = dict((kind, int(qos)) for kind, qos in (self._settings.get(['publishQos']) or dict()).items())
+        self.publisher.flush()
+
+        self.ingest.start()
+
         if self.baseTopic:
             self._logger.info('Enable MQTT')
+            self.controlTopics = {
+                '%s%s%s' % (self.baseTopic, 'plugin/mqtt_plug/', 'turnOn'): self.on_mqtt_turn_on,
+                '%s%s%s' % (self.baseTopic, 'plugin/mqtt_plug/', 'turnOff'): self.on_mqtt_turn_off,
+                '%s%s%s' % (self.baseTopic, 'plugin/mqtt_plug/', 'state'): self.on_mqtt_state,
+            }
             self.mqtt_subscribe('%s%s' % (self.baseTopic, 'plugin/mqtt_plug/#'), self.on_mqtt_sub)
 
-        self.devices = []
+        self.cooldownWatcher = CooldownWatcher(self._printer, self.pool, self.on_cooldown_ready,
+                                               self.on_cooldown_estimate)
+
+        self.devices.clear()
+        self.states.clear()
+        self.stateTopics.clear()
+        self.telemetryTopics.clear()
+        self.telemetry.clear()
+        self.subscriptions.merge_threshold = int(self._settings.get(['mergeSubscriptions']) or 0)
+
+        # states of the previous run are shown (as stale) until confirmed
+        self.lastStates = LastStateFile(os.path.join(self.get_plugin_data_folder(), "last_states.json"))
+        lastStates = self.lastStates.load()
 
         settingsDevices = self._settings.get(['devices'])
         if settingsDevices is not None:
-            for settingsDev in settingsDevices:
-                dev = Device(settingsDev)
-                self.devices.append(dev)
-                self.mqtt_register_device_state(dev)
-
-        self.getStateData()
+            with self.subscriptions.batch():
+                for settingsDev in settingsDevices:
+                    dev = Device(settingsDev)
+                    self.devices.add(dev)
+                    if str(dev.id) in lastStates:
+                        dev.state, since = lastStates[str(dev.id)]
+                        self.states.restore(str(dev.id), dev.state, since)
+                    else:
+                        self.states.set(str(dev.id))
+                    self.mqtt_register_device_state(dev)
+
+        if self._settings.get(['recordTraffic']):
+            maxBytes = int(self._settings.get(['recordTrafficMaxMb']) or 0) * 1024 * 1024
+            self.recorder = TrafficRecorder(os.path.join(self.get_plugin_data_folder(), "traffic.jsonl"), maxBytes)
+            self.recorder.start(dict(baseTopic=self.baseTopic, devices=self.get_serialized_devices()))
+
+    def on_shutdown(self):
+        if self.recorder is not None:
+            self.recorder.stop()
+        self.ingest.stop()
+        self.publisher.flush()
+        self.scheduler.stop()
+        self.persister.flush()
+        self.statePersister.flush()
+        self.pool.shutdown(wait=False)
 
     def on_mqtt_sub(self, topic, message, retain=None, qos=None, *args, **kwargs):
+        # Runs on the MQTT client thread: only queue the message, state
+        # messages waiting for the same topic are superseded.
+        metrics.MESSAGES_RECEIVED.inc()
+        if topic in self.controlTopics:
+            self.ingest.put((topic, next(self.controlSequence)), (topic, message, retain), control=True)
+        else:
+            self.ingest.put(topic, (topic, message, retain))
+        if self.recorder is not None:
+            self.recorder.record(topic, message, retain)
+        if self.publisher.buffered:
+            # receiving again, the connection is back
+            self.publisher.poke()
+
+    def on_mqtt_batch(self, batch):
+        changed = []
+
+        for topic, message, retain in batch:
+            try:
+                self.handle_mqtt_message(topic, message, changed)
+            except Exception:
+                self._logger.exception("Failed to handle mqtt message %s" % (topic))
+
+        if changed:
+            self._send_message("state", self.states.delta(changed))
+
+    def handle_mqtt_message(self, topic, message, changed):
         self._logger.debug("Receive mqtt message %s" % (topic))
+        start = time.perf_counter()
+
+        handler = self.controlTopics.get(topic)
+        if handler is not None:
+            metrics.MESSAGES_MATCHED.inc()
+            if type(message) == bytes:
+                message = message.decode()
+            handler(message)
+            metrics.MESSAGE_SECONDS.observe(time.perf_counter() - start)
+            return
 
-        if type(message) == bytes:
-            message = message.decode()
+        devices = self.stateTopics.match(topic)
+        telemetryDevices = self.telemetryTopics.match(topic)
+        if devices or telemetryDevices:
+            metrics.MESSAGES_MATCHED.inc()
+        for dev in devices:
+            state = dev.extractState(message)
+            if state is None:
+                continue
+            self.states.seen(str(dev.id))
+            if self.setDeviceState(dev, state):
+                changed.append(str(dev.id))
+        for dev in telemetryDevices:
+            value = dev.extractTelemetry(message)
+            if value is not None:
+                self.telemetry.add(str(dev.id), time.time(), value)
+        metrics.MESSAGE_SECONDS.observe(time.perf_counter() - start)
+
+    def loadControlPayload(self, message):
+        try:
+            payload = json.loads(message)
+        except ValueError:
+            metrics.JSON_DECODE_FAILURES.inc()
+            self._logger.warn('Invalid MQTT request : %s', message)
+            return dict()
+        return payload if type(payload) == dict else dict()
+
+    def on_mqtt_turn_on(self, message):
+        self._logger.info('MQTT request turn on : %s', message)
+        payload = self.loadControlPayload(message)
+        if 'id' in payload:
+            dev = self.getDeviceFromId(payload['id'])
+            if dev is not None:
+                self._logger.info('MQTT turn on : %s', dev.deviceName)
+                self.turnOn(dev)
+
+    def on_mqtt_turn_off(self, message):
+        self._logger.info('MQTT request turn off : %s', message)
+        payload = self.loadControlPayload(message)
+        if 'id' in payload:
+            dev = self.getDeviceFromId(payload['id'])
+            if dev is not None:
+                self._logger.info('MQTT turn off : %s', dev.deviceName)
+                self.turnOff(dev)
 
-        if self.baseTopic is None:
-            if topic == '%s%s%s' % (self.baseTopic, 'plugin/mqtt_plug/', 'turnOn'):
-                self._logger.info('MQTT request turn on : %s', message)
-                payload = json.loads(message)
-                if 'id' in payload:
-                    dev = self.getDeviceFromId(payload['id'])
-                    if dev is not None:
-                        self._logger.info('MQTT turn on : %s', dev['name'])
-                        self.turnOn(dev)
-
-            elif topic == '%s%s%s' % (self.baseTopic, 'plugin/mqtt_plug/', 'turnOff'):
-                self._logger.info('MQTT request turn off : %s', message)
-                payload = json.loads(message)
-                if 'id' in payload:
-                    dev = self.getDeviceFromId(payload['id'])
-                    if dev is not None:
-                        self._logger.info('MQTT turn off : %s', dev['name'])
-                        self.turnOff(dev)
-            elif topic == '%s%s%s' % (self.baseTopic, 'plugin/mqtt_plug/', 'state'):
-                self.getStateData()
-
-        stateChanged = False
+    def on_mqtt_state(self, message):
+        self.publishStateData()
 
-        for dev in self.devices:
-            if dev.stateTopic == topic:
-                if len(message) and message[0] == '{':
-                    data = json.loads(message)
-                    if 'state' in data:
-                        dev.state = data['state'] == dev.onValue
-                        stateChanged = True
-                else:
-                    dev.state = dev.onValue == message
-                    stateChanged = True
-
-        if stateChanged:
-            self._send_message("sidebar", self.sidebarInfoData())
-            self._send_message("navbar", self.navbarInfoData())
+    def isMqttConnected(self):
+        # without the MQTT plugin mqtt_publish is a no-op, keep the messages.
+        # Otherwise best effort, a refused publish (the helper returns False)
+        # is what makes messages wait
+        if self.mqttPlugin is None:
+            return False
+        return bool(getattr(self.mqttPlugin, '_mqtt_connected', True))
 
-    def mqtt_publish_plugin(self, topic, payload):
+    def mqtt_publish_plugin(self, topic, payload, retained=False, dedupe=True):
         if self.baseTopic is None:
+            self._logger.debug("No MQTT base topic, %s not published", topic)
+            self.publisher.drop('plugin')
             return
 
-        self.mqtt_publish('%s%s%s' % (self.baseTopic, 'plugin/mqtt_plug/', topic), payload)
+        self.publisher.publish('plugin', '%s%s%s' % (self.baseTopic, 'plugin/mqtt_plug/', topic), payload,
+                               retained=retained, dedupe=dedupe)
 
     def mqtt_register_device_state(self, device: Device):
-        self.mqtt_subscribe(device.stateTopic, self.on_mqtt_sub)
+        self.stateTopics.add(device.stateTopic, device)
+        self.subscriptions.acquire(device.stateTopic)
+        if device.telemetryTopic:
+            self.telemetryTopics.add(device.telemetryTopic, device)
+            self.subscriptions.acquire(device.telemetryTopic)
 
     def mqtt_unregister_device_state(self, device: Device):
-        pass
+        self.stateTopics.remove(device.stateTopic, device)
+        self.subscriptions.release(device.stateTopic)
+        if device.telemetryTopic:
+            self.telemetryTopics.remove(device.telemetryTopic, device)
+            self.subscriptions.release(device.telemetryTopic)
 
     # ~~ SettingsPlugin mixin
 
@@ -150,6 +309,17 @@ class MqttPlugPlugin(
         return dict(
             # put your plugin's default settings here
             devices=[],
+            cooldownTrigger="event",
+            # subscribe with a + wildcard when at least this many state
+            # topics differ by one level, 0 to disable
+            mergeSubscriptions=0,
+            # append the received MQTT messages to traffic.jsonl in the
+            # plugin data folder, see benchmarks/replay.py
+            recordTraffic=False,
+            recordTrafficMaxMb=50,
+            # QoS of the published messages by class: device switch
+            # commands and the plugin topics (state, ...)
+            publishQos=dict(switch=1, plugin=0),
             config_version_key=1
         )
 
@@ -161,8 +331,7 @@ class MqttPlugPlugin(
             dict(type="wizard", custom_bindings=True),
             dict(type="sidebar", custom_bindings=True)
         ]
-        for i in range(len(self.devices)):
-            dev = self.devices[i]
+        for i, dev in enumerate(self.devices):
             hidden = not dev.showNavbarIcon and not dev.showNavbarName
             item = dict(
                 type="navbar",
@@ -181,8 +350,8 @@ class MqttPlugPlugin(
     def get_template_vars(self):
         return dict(
             baseTopic=self.baseTopic,
-            devices=self.devices,
-            shutdownAt=self.shutdownAt,
+            devices=list(self.devices),
+            shutdownAt=dict((device_id, entry.shutdownAt) for device_id, entry in self.schedules.snapshot().items()),
             hasPalette2='palette2' in self._plugin_manager.enabled_plugins
         )
 
@@ -230,18 +399,15 @@ class MqttPlugPlugin(
         )
 
     def navbarInfoData(self):
+        version, state = self.states.versioned_snapshot()
         return dict(
-            state=self.getStateData()
+            state=state,
+            version=version
         )
 
     def planStop(self, dev: Device, force_postpone=False):
-        if str(dev.id) in self.stopTimer and self.stopTimer[str(dev.id)] is not None:
-            self.stopTimer[str(dev.id)].cancel()
-            self.stopTimer[str(dev.id)] = None
-
-        if str(dev.id) in self.stopCooldown and self.stopCooldown[str(dev.id)] is not None:
-            self.stopCooldown[str(dev.id)].cancel()
-            self.stopCooldown[str(dev.id)] = None
+        # a time mode deadline is kept to be postponed
+        self.schedules.cancel(str(dev.id), keep_deadline=True)
 
         if dev.shutdownType == "time" or force_postpone:
             delay = dev.postponeDelay if force_postpone else dev.stopDelay
@@ -250,47 +416,68 @@ class MqttPlugPlugin(
             self.planStopCooldown(dev)
 
     def planStopCooldown(self, dev: Device):
+        if self._settings.get(['cooldownTrigger']) == "event":
+            self.schedules.set(str(dev.id), stopCooldown=self.cooldownWatcher.watch(dev))
+            self._send_message("sidebar", self.sidebarInfoData())
+            self.cooldownWatcher.poke()
+            return
 
         hotend_request = int(dev.hotendTemp)
         bed_request = int(dev.bedTemp)
+        estimator = CooldownEstimator()
+        estimator.load_history(self._printer.get_temperature_history())
+
+        # the task currently waiting, a wrapper whose task was replaced or
+        # cancelled in the meantime does nothing
+        current = [None]
 
         def wrapper():
             temps = self._printer.get_current_temperatures()
 
-            ready_for_stop = True
-
-            if bed_request > -1 and temps['bed']['actual'] > bed_request:
-                ready_for_stop = False
-            if hotend_request > -1 and 'tool0' in temps and temps['tool0']['actual'] > hotend_request:
-                ready_for_stop = False
-
-            if ready_for_stop:
-                self.turnOff(dev)
-                self.stopCooldown[str(dev.id)] = None
+            if is_cooled_down(temps, hotend_request, bed_request):
+                if self.schedules.swap(str(dev.id), 'stopCooldown', current[0], None):
+                    self.turnOff(dev)
             else:
-                self.stopCooldown[str(dev.id)] = threading.Timer(5, wrapper)
-                self.stopCooldown[str(dev.id)].start()
+                now = time.time()
+                estimator.add(dict(temps, time=now))
+                prediction = estimator.predict(hotend_request, bed_request)
+                task = self.scheduler.schedule(next_check_delay(prediction, now), wrapper)
+                if not self.schedules.swap(str(dev.id), 'stopCooldown', current[0], task):
+                    task.cancel()
+                    return
+                current[0] = task
+                self.setCooldownEstimate(dev, prediction[0] if prediction is not None and prediction[1] else None)
             self._send_message("sidebar", self.sidebarInfoData())
 
-        self.stopCooldown[str(dev.id)] = threading.Timer(5, wrapper)
-        self.stopCooldown[str(dev.id)].start()
+        current[0] = self.scheduler.schedule(5, wrapper)
+        self.schedules.set(str(dev.id), stopCooldown=current[0])
         self._send_message("sidebar", self.sidebarInfoData())
 
+    def on_cooldown_ready(self, dev: Device):
+        self.turnOff(dev)
+
+    def on_cooldown_estimate(self, dev: Device, eta):
+        if self.schedules.get(str(dev.id)).stopCooldown is None:
+            return
+        self.setCooldownEstimate(dev, eta)
+        self._send_message("sidebar", self.sidebarInfoData())
+
+    def setCooldownEstimate(self, dev: Device, eta):
+        shutdownAt = math.ceil(eta) if eta is not None else None
+        # only while still waiting, the wait may have been cancelled
+        self.schedules.update(str(dev.id), lambda entry: entry._replace(shutdownAt=shutdownAt)
+                              if entry.stopCooldown is not None else entry)
+
     def planStopTimeMode(self, dev, delay):
         now = math.ceil(time.time())
 
-        if self.shutdownAt[str(dev.id)] is not None:
-            self.shutdownAt[str(dev.id)] += delay
-        else:
-            self.shutdownAt[str(dev.id)] = now + delay
-        stopIn = (self.shutdownAt[str(dev.id)] - now)
+        stopIn = self.schedules.postpone(str(dev.id), delay, now) - now
         self._logger.info("Schedule turn off in %d s" % stopIn)
 
         def wrapper():
             self.turnOff(dev)
 
-        self.stopTimer[str(dev.id)] = threading.Timer(stopIn, wrapper)
-        self.stopTimer[str(dev.id)].start()
+        self.schedules.set(str(dev.id), stopTimer=self.scheduler.schedule(stopIn, wrapper))
 
         self._send_message("sidebar", self.sidebarInfoData())
 
@@ -301,36 +488,63 @@ class MqttPlugPlugin(
         except:
             self._logger.error('Failed to connect to palette')
 
-    def turnOn(self, device: Device):
-        self.turnOnOutlet(device)
+    def turnOn(self, device: Device) -> Job:
+        return self.turnOnMany([device])
 
-        connection_timer = int(device.connectionDelay)
+    def turnOnMany(self, devices: [Device]) -> Job:
+        """
+        Switch the outlets on and connect the printer (or palette 2) once,
+        after the longest connection delay. Nothing runs on the calling
+        thread: the returned job can be polled on /jobs/<id>.
+        """
+        printer_delay = -1
+        palette2_delay = -1
 
-        def connect():
+        for device in devices:
+            connection_timer = int(device.connectionDelay)
             if device.connectPalette2:
-                self.connect_palette2()
+                palette2_delay = max(palette2_delay, connection_timer)
             else:
-                self._printer.connect()
+                printer_delay = max(printer_delay, connection_timer)
 
-        if connection_timer >= -1:
-            c = threading.Timer(connection_timer, connect)
-            c.start()
+        def publish():
+            with self.switchBatch():
+                for device in devices:
+                    self.turnOnOutlet(device)
+
+        futures = dict(publish=self.scheduler.call_soon(publish))
+        if printer_delay > -1:
+            futures['connect'] = self.scheduler.submit_later(printer_delay, self._printer.connect)
+        if palette2_delay > -1:
+            futures['connectPalette2'] = self.scheduler.submit_later(palette2_delay, self.connect_palette2)
 
         self._send_message("sidebar", self.sidebarInfoData())
         self._send_message("navbar", self.navbarInfoData())
 
+        return self.jobs.add("turnOn", futures)
+
     def turnOnOutlet(self, device: Device):
-        # device.state = True
-        self.mqtt_publish(device.switchTopic, device.onValue, retained=True)
+        self.switchOutlet(device, True)
+
+    def switchOutlet(self, device: Device, state):
+        # device.state is only updated when the device reports it
+        if self.commands.isPending(device, state):
+            self._logger.debug('%s already switching, skip command', device.deviceName)
+            return
+        # tracked first, the state may come back before publish returns
+        self.commands.track(device, state)
+        self.publishSwitch(device, state)
+
+    def publishSwitch(self, device: Device, state):
+        self.publisher.publish('switch', device.switchTopic, device.onValue if state else device.offValue,
+                               retained=True)
 
     def turnOff(self, device: Device):
-        self.shutdownAt[str(device.id)] = None
-        if device.id in self.stopTimer and self.stopTimer[str(device.id)] is not None:
-            self.stopTimer[str(device.id)].cancel()
-            self.stopTimer[str(device.id)] = None
-        if device.id in self.stopCooldown and self.stopCooldown[str(device.id)] is not None:
-            self.stopCooldown[str(device.id)].cancel()
-            self.stopCooldown[str(device.id)] = None
+        self.turnOffMany([device])
+
+    def turnOffMany(self, devices: [Device]):
+        for device in devices:
+            self.schedules.cancel(str(device.id))
 
         self._send_message("sidebar", self.sidebarInfoData())
         if self._printer.is_printing():
@@ -345,12 +559,14 @@ class MqttPlugPlugin(
 
         self._logger.debug('stop')
         self._printer.disconnect()
-        self.turnOffOutlet(device)
+        # the navbar message below carries the pending flags
+        with self.switchBatch(push=False):
+            for device in devices:
+                self.turnOffOutlet(device)
         self._send_message("navbar", self.navbarInfoData())
 
     def turnOffOutlet(self, device: Device):
-        # device.state = True
-        self.mqtt_publish(device.switchTopic, device.offValue, retained=True)
+        self.switchOutlet(device, False)
 
     def get_api_commands(self):
         return dict(
@@ -358,32 +574,38 @@ class MqttPlugPlugin(
         )
 
     def getDeviceFromId(self, id) -> Device or None:
-        selected_devices = self.devices
         if id is None or id == '-1':
             return None
-        if type(id) == str:
-            id = uuid.UUID(id)
-        for dev in selected_devices:
-            if dev.id == id:
-                return dev
-        return None
+        return self.devices.get(id)
+
+    def getOctopodDevice(self, ip) -> Device or None:
+        # Octopod sends what the user typed as the plug "ip": an id or a name
+        return self.getDeviceFromId(str(ip)) or self.devices.withName(ip)
+
+    def octopodStatus(self, device: Device):
+        status = self.getStateDataById(device.id)
+        return dict(ip=str(device.id), currentState=("on" if status['state'] else "off"))
+
+    def getDevicesFromIds(self, ids) -> [Device]:
+        devices = dict()
+        for id in ids:
+            device = self.getDeviceFromId(id)
+            if device is not None:
+                devices[device.id] = device
+        return list(devices.values())
 
     def on_api_command(self, command, data):
         import flask
         if command == "turnOn":
             if 'dev' in data:
                 device = self.getDeviceFromId(data['dev']['id'])
+                if device is not None:
+                    return flask.jsonify(self.turnOn(device).status())
+            elif 'ip' in data:  # Octopod
+                device = self.getOctopodDevice(data['ip'])
                 if device is not None:
                     self.turnOn(device)
-            # elif 'ip' in data:  # Octopod ?
-            #     device = self.getDeviceFromId(int(data['ip']))
-            #     if device is None:
-            #         pass
-            #     else:
-            #         self.turnOn(device)
-            #         status = self.getStateDataById(device['id'])
-            #         res = dict(ip=str(device['id']), currentState=("on" if status['state'] else "off"))
-            #         return flask.jsonify(res)
+                    return flask.jsonify(self.octopodStatus(device))
             else:
                 self._logger.warn('turn on without device data')
         elif command == "turnOff":
@@ -391,15 +613,11 @@ class MqttPlugPlugin(
                 device = self.getDeviceFromId(data['dev']['id'])
                 if device is not None:
                     self.turnOff(device)
-            # elif 'ip' in data:  # Octopod ?
-            #     device = self.getDeviceFromId(int(data['ip']))
-            #     if device is None:
-            #         pass
-            #     else:
-            #         self.turnOff(device)
-            #         status = self.getStateDataById(device['id'])
-            #         res = dict(ip=str(device['id']), currentState=("on" if status['state'] else "off"))
-            #         return flask.jsonify(res)
+            elif 'ip' in data:  # Octopod
+                device = self.getOctopodDevice(data['ip'])
+                if device is not None:
+                    self.turnOff(device)
+                    return flask.jsonify(self.octopodStatus(device))
             else:
                 self._logger.warn('turn off without device data')
         elif command == "checkStatus":
@@ -407,14 +625,11 @@ class MqttPlugPlugin(
             if 'dev' in data:
                 status = self.getStateDataById(data["dev"]['id'])
                 return flask.jsonify(status)
-            elif 'ip' in data:  # Octopod ?
-                device = self.getDeviceFromId(int(data['ip']))
-                if device is None:
-                    pass
-                else:
-                    status = self.getStateDataById(device['id'])
-                    res = dict(ip=str(device['id']), currentState=("on" if status['state'] else "off"))
-                    return flask.jsonify(res)
+            elif 'ip' in data:  # Octopod
+                device = self.getOctopodDevice(data['ip'])
+                if device is not None:
+                    return flask.jsonify(self.octopodStatus(device))
+                return flask.make_response("Unknown device", 404)
             else:
                 self._logger.warn('checkStatus without device data')
 
@@ -427,35 +642,125 @@ class MqttPlugPlugin(
                  roles=["admins"])
         ]
 
+    def countActiveTimers(self):
+        return sum((entry.stopTimer is not None) + (entry.stopCooldown is not None)
+                   for entry in self.schedules.snapshot().values())
+
+    @octoprint.plugin.BlueprintPlugin.route("/commands/info", methods=["GET"])
+    def commandsInfo(self):
+        return flask.make_response(json.dumps(self.commands.stats()), 200)
+
+    @octoprint.plugin.BlueprintPlugin.route("/metrics", methods=["GET"])
+    def metricsInfo(self):
+        response = flask.make_response(metrics.REGISTRY.render(), 200)
+        response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+        return response
+
+    @octoprint.plugin.BlueprintPlugin.route("/publisher/info", methods=["GET"])
+    def publisherInfo(self):
+        return flask.make_response(json.dumps(self.publisher.stats()), 200)
+
+    @octoprint.plugin.BlueprintPlugin.route("/ingest/info", methods=["GET"])
+    def ingestInfo(self):
+        return flask.make_response(json.dumps(self.ingest.stats()), 200)
+
+    def conditionalResponse(self, etag, build):
+        if etag in flask.request.if_none_match:
+            response = flask.make_response("", 304)
+        else:
+            response = flask.make_response(build(), 200)
+            response.mimetype = "application/json"
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    def navbarEtag(self):
+        return "%s-n%d" % (self.bootId, self.states.version)
+
+    def sidebarEtag(self):
+        return "%s-s%d-%d" % (self.bootId, self.schedules.version, self.devices.version)
+
+    def devicesEtag(self):
+        return "%s-d%d" % (self.bootId, self.devices.version)
+
+    # columns of the /fleet rows
+    FLEET_FIELDS = ("id", "name", "state", "pending", "stale", "since", "shutdownAt", "cooldown", "lastSeen")
+
+    def fleetData(self):
+        """
+        (etag, body) of /fleet, rebuilt when a device, a state or a schedule
+        changed, last seen times may be up to 30 seconds late.
+        """
+        key = (self.devices.version, self.states.version, self.schedules.version)
+        cached = self.fleetCache
+        if cached is not None and cached[0] == key and \
+                (cached[1] == self.states.seenCount or time.monotonic() - cached[2] < 30):
+            return cached[3], cached[4]
+
+        with self.fleetLock:
+            seenCount = self.states.seenCount
+            states = self.states.snapshot()
+            schedules = self.schedules.snapshot()
+            rows = []
+            for dev in self.devices:
+                device_id = str(dev.id)
+                state = states.get(device_id) or dict()
+                schedule = schedules.get(device_id)
+                rows.append([
+                    device_id,
+                    dev.deviceName,
+                    1 if state.get('state') else 0,
+                    1 if state.get('pending') else 0,
+                    1 if state.get('stale') else 0,
+                    state.get('since'),
+                    schedule.shutdownAt if schedule is not None else None,
+                    1 if schedule is not None and schedule.stopCooldown is not None else 0,
+                    self.states.lastSeen(device_id),
+                ])
+            self.fleetBuilds += 1
+            etag = "%s-f%d" % (self.bootId, self.fleetBuilds)
+            body = json.dumps(dict(fields=self.FLEET_FIELDS, devices=rows), separators=(',', ':'))
+            self.fleetCache = (key, seenCount, time.monotonic(), etag, body)
+            return etag, body
+
     @octoprint.plugin.BlueprintPlugin.route("/navbar/info", methods=["GET"])
     def navbarInfo(self):
-        data = self.navbarInfoData()
-        return flask.make_response(json.dumps(data), 200)
+        return self.conditionalResponse(
+            self.navbarEtag(),
+            lambda: json.dumps(self.navbarInfoData(), separators=(',', ':')))
+
+    @octoprint.plugin.BlueprintPlugin.route("/fleet", methods=["GET"])
+    def fleetInfo(self):
+        etag, body = self.fleetData()
+        return self.conditionalResponse(etag, lambda: body)
 
     ##Sidebar
 
     def sidebarInfoData(self):
         # TODO : info stop cooldown
         selected_devices = self.devices
+        schedules = self.schedules.snapshot()
+        shutdownAt = dict()
         cooldown_wait = dict()
         for dev in selected_devices:
-            if str(dev.id) not in self.shutdownAt:
-                self.shutdownAt[str(dev.id)] = None
+            entry = schedules.get(str(dev.id))
+            shutdownAt[str(dev.id)] = entry.shutdownAt if entry is not None else None
             if dev.shutdownType == "cooldown":
                 val = None
-                if str(dev.id) in self.stopCooldown and self.stopCooldown[str(dev.id)] is not None:
+                if entry is not None and entry.stopCooldown is not None:
                     val = True
                 cooldown_wait[str(dev.id)] = val
 
         return dict(
-            shutdownAt=self.shutdownAt,
+            shutdownAt=shutdownAt,
             cooldown_wait=cooldown_wait
         )
 
     @octoprint.plugin.BlueprintPlugin.route("/sidebar/info", methods=["GET"])
     def sidebarInfo(self):
-        data = self.sidebarInfoData()
-        return flask.make_response(json.dumps(data), 200)
+        return self.conditionalResponse(
+            self.sidebarEtag(),
+            lambda: json.dumps(self.sidebarInfoData(), separators=(',', ':')))
 
     @octoprint.plugin.BlueprintPlugin.route("/sidebar/postpone", methods=["POST"])
     def sidebarPostponeShutdown(self):
@@ -474,14 +779,8 @@ class MqttPlugPlugin(
         dev = flask.request.json['dev']
         device = self.getDeviceFromId(dev['id'])
 
-        if str(dev['id']) in self.stopTimer and self.stopTimer[str(dev['id'])] is not None:
-            self.stopTimer[str(dev['id'])].cancel()
-            self.shutdownAt[str(dev['id'])] = None
-            self.stopTimer[str(dev['id'])] = None
-        if str(dev['id']) in self.stopCooldown and self.stopCooldown[str(dev['id'])] is not None:
-            self.stopCooldown[str(dev['id'])].cancel()
-            self.shutdownAt[str(dev['id'])] = None
-            self.stopCooldown[str(dev['id'])] = None
+        if device is not None:
+            self.schedules.cancel(str(device.id))
 
         self._send_message("sidebar", self.sidebarInfoData())
         return self.sidebarInfo()
@@ -514,38 +813,77 @@ class MqttPlugPlugin(
 
         return flask.make_response("OK", 200)
 
+    def devicesResponse(self):
+        response = flask.make_response(self.devices.toJson(), 200)
+        response.mimetype = "application/json"
+        return response
+
     @octoprint.plugin.BlueprintPlugin.route("/devices", methods=["GET"])
     def listDevices(self):
-        return flask.make_response(json.dumps(self.get_serialized_devices(), indent=4), 200)
-
-    @octoprint.plugin.BlueprintPlugin.route("/device/save", methods=["POST"])
-    def saveDevice(self):
-        if not "device" in flask.request.json:
-            return flask.make_response("Missing device", 400)
-
-        dev = flask.request.json['device']
+        return self.conditionalResponse(self.devicesEtag(), self.devices.toJson)
+
+    def validateDeviceData(self, dev):
+        if type(dev) != dict:
+            raise ValueError("Invalid device: %r" % (dev,))
+        # new devices have no id or -1, Device() parses the others
+        if dev.get('id') is not None and dev['id'] != "-1" and type(dev['id']) != uuid.UUID:
+            try:
+                uuid.UUID(dev['id'])
+            except (AttributeError, TypeError, ValueError):
+                raise ValueError("Invalid id: %r" % (dev['id'],))
+        return validateData(dev)
+
+    def buildDevice(self, dev) -> Device:
+        # the registered device to update, or a new one not registered yet
         device = None
-
         if 'id' in dev:
             device = self.getDeviceFromId(dev['id'])
+        return device if device is not None else Device(dev)
 
-        if device is not None:
-            requireChangeTopic = False
-            if device.stateTopic != dev['stateTopic']:
-                requireChangeTopic = True
+    def upsertDevice(self, dev, device: Device = None) -> Device:
+        if device is None:
+            device = self.buildDevice(dev)
+
+        if device in self.devices:
+            if any(key in dev and getattr(device, key) != dev[key] for key in ('stateTopic', 'telemetryTopic')):
                 self.mqtt_unregister_device_state(device)
-            device.update(dev)
-            if requireChangeTopic:
+                device.update(dev)
                 self.mqtt_register_device_state(device)
+            else:
+                device.update(dev)
+            self.devices.touch()
         else:
-            device = Device(dev)
-            self.devices.append(device)
+            self.devices.add(device)
+            self.states.set(str(device.id))
             self.mqtt_register_device_state(device)
 
-        self.write_devices_in_settings()
-        self._settings.save()
+        return device
+
+    def removeDevice(self, device: Device):
+        self.commands.cancel(device)
+        self.schedules.cancel(str(device.id))
+        self.mqtt_unregister_device_state(device)
+        self.devices.remove(device)
+        self.states.remove(str(device.id))
+        self.telemetry.remove(str(device.id))
+        self.statePersister.markDirty()
+
+    @octoprint.plugin.BlueprintPlugin.route("/device/save", methods=["POST"])
+    def saveDevice(self):
+        if not "device" in flask.request.json:
+            return flask.make_response("Missing device", 400)
 
-        return flask.make_response(json.dumps(self.get_serialized_devices(), indent=4), 200)
+        dev = flask.request.json['device']
+
+        try:
+            self.validateDeviceData(dev)
+        except ValueError as e:
+            return flask.make_response(str(e), 400)
+
+        device = self.upsertDevice(dev)
+        self.persister.markDirty()
+
+        return self.devicesResponse()
 
     @octoprint.plugin.BlueprintPlugin.route("/device/delete", methods=["POST"])
     def deleteDevice(self):
@@ -555,41 +893,218 @@ class MqttPlugPlugin(
         device_id = flask.request.json['device_id']
         device = self.getDeviceFromId(device_id)
         if device is not None:
-            self.devices.remove(device)
+            self.removeDevice(device)
+            self.persister.markDirty()
+
+        return self.devicesResponse()
+
+    @octoprint.plugin.BlueprintPlugin.route("/devices/bulk/save", methods=["POST"])
+    def bulkSaveDevices(self):
+        if not "devices" in flask.request.json:
+            return flask.make_response("Missing devices", 400)
+
+        devs = flask.request.json['devices']
+
+        # validate and build everything before changing anything
+        devices = []
+        new = dict()
+        for i, dev in enumerate(devs):
+            try:
+                self.validateDeviceData(dev)
+                # a new device listed twice is added then updated
+                device = new.get(str(dev.get('id'))) or self.buildDevice(dev)
+                if device not in self.devices:
+                    new[str(device.id)] = device
+                devices.append(device)
+            except ValueError as e:
+                return flask.make_response("Device %d: %s" % (i, e), 400)
+
+        with self.subscriptions.batch():
+            for dev, device in zip(devs, devices):
+                self.upsertDevice(dev, device)
+
+        if devices:
+            self.persister.markDirty()
+            self._send_message("navbar", self.navbarInfoData())
 
-        self.write_devices_in_settings()
-        self._settings.save()
+        return self.devicesResponse()
 
-        return flask.make_response(json.dumps(self.get_serialized_devices(), indent=4), 200)
+    @octoprint.plugin.BlueprintPlugin.route("/devices/bulk/delete", methods=["POST"])
+    def bulkDeleteDevices(self):
+        if not "device_ids" in flask.request.json:
+            return flask.make_response("Missing device_ids", 400)
 
-    def getStateData(self):
-        res = dict()
+        devices = self.getDevicesFromIds(flask.request.json['device_ids'])
+        with self.subscriptions.batch():
+            for device in devices:
+                self.removeDevice(device)
 
-        for device in self.devices:
-            if device.id is None:
-                continue
-            res[str(device.id)] = self.getStateDataById(device.id)
-            self.mqtt_publish_plugin('state/%s' % str(device.id), res[str(device.id)])
+        if devices:
+            self.persister.markDirty()
+            self._send_message("navbar", self.navbarInfoData())
 
-        return res
+        return self.devicesResponse()
 
-    def getStateDataById(self, device_id):
+    @octoprint.plugin.BlueprintPlugin.route("/devices/bulk/switch", methods=["POST"])
+    def bulkSwitchDevices(self):
+        data = flask.request.json
+        if not "state" in data:
+            return flask.make_response("Missing state", 400)
 
-        device = self.getDeviceFromId(device_id)
+        if "tag" in data:
+            devices = self.devices.withTag(data['tag'])
+        elif "device_ids" in data:
+            devices = self.getDevicesFromIds(data['device_ids'])
+        else:
+            return flask.make_response("Missing device_ids or tag", 400)
 
-        if device is None:
-            return dict(state=False)
+        state = data['state']
+        if type(state) == str:
+            state = state.lower() in ("on", "true", "1")
 
         res = dict(
-            state=device.state
+            state=state,
+            devices=[str(device.id) for device in devices]
         )
+        if devices:
+            if state:
+                res['job'] = self.turnOnMany(devices).status()
+            else:
+                self.turnOffMany(devices)
+
+        return flask.make_response(json.dumps(res), 200)
+
+    @octoprint.plugin.BlueprintPlugin.route("/jobs/<job_id>", methods=["GET"])
+    def jobInfo(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return flask.make_response("Unknown job", 404)
+        return flask.make_response(json.dumps(job.status()), 200)
+
+    @octoprint.plugin.BlueprintPlugin.route("/telemetry/<device_id>", methods=["GET"])
+    def telemetryInfo(self, device_id):
+        device = self.getDeviceFromId(device_id)
+        if device is None:
+            return flask.make_response("Unknown device", 404)
+
+        # epoch seconds, the last hour in about 300 points by default
+        try:
+            end = float(flask.request.args.get('end') or time.time())
+            start = float(flask.request.args.get('start') or end - 3600)
+            resolution = float(flask.request.args.get('resolution') or max(1, (end - start) / 300))
+        except ValueError:
+            return flask.make_response("Invalid range", 400)
+        if not all(math.isfinite(v) for v in (start, end, resolution)):
+            return flask.make_response("Invalid range", 400)
+        if end <= start or resolution <= 0 or (end - start) / resolution > 10000:
+            return flask.make_response("Invalid range", 400)
+
+        res = self.telemetry.query(str(device.id), start, end, resolution)
+        if res is None:
+            res = dict(t=[], min=[], max=[], mean=[], step=resolution)
+        res['id'] = str(device.id)
+        response = flask.make_response(json.dumps(res, separators=(',', ':')), 200)
+        response.mimetype = "application/json"
+        return response
+
+    def getStateData(self):
+        return self.states.snapshot()
+
+    def getStateDataById(self, device_id):
+        res = self.states.get(str(device_id))
+
+        if res is None:
+            return dict(state=False)
+
         return res
 
+    def setDeviceState(self, device: Device, state) -> bool:
+        device.state = state
+        acknowledged = self.commands.acknowledge(device, state)
+        if not self.states.set(str(device.id), state, pending=False if acknowledged else None):
+            return False
+
+        self.statePersister.markDirty()
+        self.publishDeviceState(device)
+        return True
+
+    @contextlib.contextmanager
+    def switchBatch(self, push=True):
+        """
+        Collect the pending flag changes of the switch commands sent in the
+        block (on this thread) into a single state message.
+        """
+        changed = []
+        self.pendingBatch.changed = changed
+        try:
+            yield
+        finally:
+            self.pendingBatch.changed = None
+            if changed and push:
+                self._send_message("state", self.states.delta(changed))
+
+    def on_command_pending(self, device: Device, pending):
+        if device not in self.devices:
+            return
+        if self.states.set(str(device.id), pending=pending):
+            changed = getattr(self.pendingBatch, 'changed', None)
+            if changed is not None:
+                changed.append(str(device.id))
+            else:
+                self._send_message("state", self.states.delta([str(device.id)]))
+
+    def publishDeviceState(self, device: Device, dedupe=True):
+        # pending and stale only matter to the UI, keep them out of the
+        # retained message
+        status = self.getStateDataById(device.id)
+        self.mqtt_publish_plugin('state/%s' % str(device.id), dict(state=status['state'], since=status.get('since')),
+                                 retained=True, dedupe=dedupe)
+
+    def publishStateData(self):
+        # explicit refresh: the broker may have lost the retained messages
+        for device in self.devices:
+            self.publishDeviceState(device, dedupe=False)
+
     def _send_message(self, msg_type, payload):
         self._logger.debug("send message type {}".format(msg_type))
-        self._plugin_manager.send_plugin_message(
-            self._identifier,
-            dict(type=msg_type, payload=payload))
+        message = self.messageLog.append(msg_type, payload)
+        metrics.UI_PUSHES.inc(label=msg_type)
+        if metrics.REGISTRY.active:
+            metrics.UI_PUSH_BYTES.observe(len(json.dumps(message)))
+        self._plugin_manager.send_plugin_message(self._identifier, message)
+
+    def syncData(self, since=None):
+        seq = self.messageLog.seq
+        messages = None
+        if since is not None:
+            messages = self.messageLog.since(since)
+
+        if messages is not None:
+            return dict(boot=self.bootId, seq=messages[-1]['seq'] if messages else since, messages=messages)
+
+        # too far behind (or first sync): send everything, the messages
+        # sent while building it will be replayed by the client
+        return dict(
+            boot=self.bootId,
+            seq=seq,
+            snapshot=dict(
+                sidebar=self.sidebarInfoData(),
+                navbar=self.navbarInfoData()
+            )
+        )
+
+    @octoprint.plugin.BlueprintPlugin.route("/sync", methods=["GET"])
+    def sync(self):
+        since = None
+        if flask.request.args.get('since') and flask.request.args.get('boot') == self.bootId:
+            try:
+                since = int(flask.request.args['since'])
+            except ValueError:
+                return flask.make_response("Invalid since", 400)
+
+        response = flask.make_response(json.dumps(self.syncData(since), separators=(',', ':')), 200)
+        response.mimetype = "application/json"
+        return response
 
     def get_settings_version(self):
         return 1
@@ -614,12 +1129,7 @@ class MqttPlugPlugin(
             if schedule_stop:
                 self.planStop(dev)
             elif event == 'PrintStarted':
-                if str(dev.id) in self.stopTimer and self.stopTimer[str(dev.id)] is not None:
-                    self.stopTimer[str(dev.id)].cancel()
-                    self.stopTimer[str(dev.id)] = None
-                if str(dev.id) in self.stopCooldown and self.stopCooldown[str(dev.id)] is not None:
-                    self.stopCooldown[str(dev.id)].cancel()
-                    self.stopCooldown[str(dev.id)] = None
+                self.schedules.cancel(str(dev.id))
 
 
 __plugin_name__ = "OctoPrint Mqtt Plug"
@@ -0,0 +1,145 @@
+import threading
+import time
+
+from octoprint_mqtt_plug import metrics
+
+
+class PendingCommand:
+    __slots__ = ('device', 'expected', 'sentAt', 'attempts', 'task')
+
+    def __init__(self, device, expected, sentAt):
+        self.device = device
+        self.expected = expected
+        self.sentAt = sentAt
+        self.attempts = 1
+        self.task = None
+
+
+class CommandStats:
+    __slots__ = ('acknowledged', 'retries', 'failures', 'lastRtt', 'meanRtt', 'maxRtt')
+
+    def __init__(self):
+        self.acknowledged = 0
+        self.retries = 0
+        self.failures = 0
+        self.lastRtt = None
+        self.meanRtt = None
+        self.maxRtt = None
+
+    def record(self, rtt):
+        self.acknowledged += 1
+        self.lastRtt = rtt
+        self.maxRtt = rtt if self.maxRtt is None else max(self.maxRtt, rtt)
+        # exponential moving average, recent commands matter more
+        self.meanRtt = rtt if self.meanRtt is None else self.meanRtt * 0.8 + rtt * 0.2
+
+    def serialize(self):
+        return dict(
+            acknowledged=self.acknowledged,
+            retries=self.retries,
+            failures=self.failures,
+            lastRtt=self.lastRtt,
+            meanRtt=self.meanRtt,
+            maxRtt=self.maxRtt
+        )
+
+
+class CommandTracker:
+    """
+    Follow switch commands until the device reports the expected state.
+
+    Without acknowledgement after ``device.ackTimeout`` seconds the command
+    is sent again through ``resend(device, expected)``, waiting twice as
+    long each time, at most ``device.maxRetries`` times. ``on_pending`` is
+    called with the device and a boolean when it starts waiting, or stops
+    without acknowledgement (``acknowledge`` callers handle that case).
+    """
+
+    def __init__(self, scheduler, resend, on_pending):
+        self._scheduler = scheduler
+        self._resend = resend
+        self._on_pending = on_pending
+        self._lock = threading.Lock()
+        self._pending = dict()
+        self._stats = dict()
+
+    def isPending(self, device, expected=None):
+        command = self._pending.get(str(device.id))
+        return command is not None and (expected is None or command.expected == expected)
+
+    def track(self, device, expected):
+        timeout = int(device.ackTimeout)
+        if timeout <= 0:
+            return
+
+        device_id = str(device.id)
+        with self._lock:
+            previous = self._pending.get(device_id)
+            if previous is not None and previous.task is not None:
+                previous.task.cancel()
+            command = PendingCommand(device, expected, time.monotonic())
+            command.task = self._scheduler.schedule(timeout, self._timeout, command)
+            self._pending[device_id] = command
+
+        if previous is None:
+            self._on_pending(device, True)
+
+    def acknowledge(self, device, state) -> bool:
+        device_id = str(device.id)
+        with self._lock:
+            command = self._pending.get(device_id)
+            if command is None or command.expected != state:
+                return False
+            del self._pending[device_id]
+            command.task.cancel()
+            rtt = time.monotonic() - command.sentAt
+            self._statsFor(device_id).record(rtt)
+
+        metrics.SWITCH_ACK_SECONDS.observe(rtt)
+        return True
+
+    def cancel(self, device):
+        with self._lock:
+            command = self._pending.pop(str(device.id), None)
+            if command is not None:
+                command.task.cancel()
+        if command is not None:
+            self._on_pending(device, False)
+
+    def stats(self):
+        with self._lock:
+            res = dict()
+            for device_id, stats in self._stats.items():
+                res[device_id] = stats.serialize()
+                res[device_id]['pending'] = device_id in self._pending
+            return res
+
+    def _statsFor(self, device_id) -> CommandStats:
+        if device_id not in self._stats:
+            self._stats[device_id] = CommandStats()
+        return self._stats[device_id]
+
+    def _timeout(self, command):
+        device = command.device
+        device_id = str(device.id)
+        with self._lock:
+            if self._pending.get(device_id) is not command:
+                return
+            stats = self._statsFor(device_id)
+            if command.attempts > int(device.maxRetries):
+                del self._pending[device_id]
+                stats.failures += 1
+                retry = False
+            else:
+                command.attempts += 1
+                stats.retries += 1
+                delay = int(device.ackTimeout) * 2 ** (command.attempts - 1)
+                command.task = self._scheduler.schedule(delay, self._timeout, command)
+                retry = True
+
+        if retry:
+            metrics.SWITCH_RETRIES.inc()
+            self._resend(device, command.expected)
+        else:
+            metrics.SWITCH_FAILURES.inc()
+            self._on_pending(device, False)
@@ -0,0 +1,237 @@
+import collections
+import math
+import threading
+
+from octoprint.printer import PrinterCallback
+
+
+def is_cooled_down(temps, hotend_request, bed_request):
+    if bed_request > -1 and 'bed' in temps and temps['bed']['actual'] > bed_request:
+        return False
+    if hotend_request > -1 and 'tool0' in temps and temps['tool0']['actual'] > hotend_request:
+        return False
+    return True
+
+
+class CoolingModel:
+    """
+    Newton's law of cooling fitted on recent samples of one sensor.
+
+    ``T(t) = ambient + (T0 - ambient) * exp(-k * t)`` is linear in
+    ``log(T - ambient)``, so a least squares fit on the last samples gives
+    ``k`` and the time the temperature crosses a threshold.
+    """
+
+    def __init__(self, ambient=25.0, size=30, min_samples=5, min_r2=0.9):
+        self.ambient = ambient
+        self.min_samples = min_samples
+        self.min_r2 = min_r2
+        self._samples = collections.deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def clear(self):
+        self._samples.clear()
+
+    def add(self, t, temp):
+        if self._samples and t <= self._samples[-1][0]:
+            return
+        self._samples.append((t, temp))
+
+    def predict(self, threshold):
+        """
+        Return ``(time, confident)`` at which the temperature should be at or
+        below ``threshold``, or None when no prediction can be made.
+        """
+        if not self._samples:
+            return None
+        t_last, temp_last = self._samples[-1]
+        if temp_last <= threshold:
+            return t_last, True
+        if threshold <= self.ambient:
+            return None
+
+        points = [(t, math.log(temp - self.ambient)) for t, temp in self._samples if temp - self.ambient > 0.5]
+        n = len(points)
+        if n < 2:
+            return None
+
+        mean_t = sum(p[0] for p in points) / n
+        mean_y = sum(p[1] for p in points) / n
+        stt = sum((p[0] - mean_t) ** 2 for p in points)
+        if stt == 0:
+            return None
+        slope = sum((p[0] - mean_t) * (p[1] - mean_y) for p in points) / stt
+        if slope >= 0:
+            # not cooling down (yet)
+            return None
+
+        syy = sum((p[1] - mean_y) ** 2 for p in points)
+        r2 = 1.0 if syy == 0 else (slope * slope * stt) / syy
+
+        y_last = mean_y + slope * (t_last - mean_t)
+        eta = t_last + (math.log(threshold - self.ambient) - y_last) / slope
+        return max(eta, t_last), n >= self.min_samples and r2 >= self.min_r2
+
+
+class CooldownEstimator:
+    """
+    Cooling models for the hotend and the bed, fed with printer temperature
+    samples (as sent to ``on_printer_add_temperature``).
+    """
+
+    def __init__(self):
+        self.models = dict(tool0=CoolingModel(), bed=CoolingModel())
+
+    def clear(self):
+        for model in self.models.values():
+            model.clear()
+
+    def add(self, data):
+        t = data.get('time')
+        if t is None:
+            return
+        for key, model in self.models.items():
+            if key in data and data[key] and data[key].get('actual') is not None:
+                model.add(t, data[key]['actual'])
+
+    def load_history(self, history):
+        for data in history or []:
+            self.add(data)
+
+    def predict(self, hotend_request, bed_request):
+        """
+        Return ``(time, confident)`` at which both thresholds should be
+        reached, or None.
+        """
+        res = None
+        confident = True
+        for key, request in (('tool0', hotend_request), ('bed', bed_request)):
+            if request <= -1 or not len(self.models[key]):
+                continue
+            prediction = self.models[key].predict(request)
+            if prediction is None:
+                return None
+            res = prediction[0] if res is None else max(res, prediction[0])
+            confident = confident and prediction[1]
+        if res is None:
+            return None
+        return res, confident
+
+
+def next_check_delay(prediction, now, default=5, minimum=2, maximum=60):
+    """
+    Delay before the next cooldown check: ``default`` without a confident
+    prediction, otherwise a bit before the predicted crossing time.
+    """
+    if prediction is None or not prediction[1]:
+        return default
+    remaining = prediction[0] - now
+    if remaining > 10:
+        remaining *= 0.8
+    return min(max(remaining, minimum), maximum)
+
+
+class _CooldownHandle:
+    __slots__ = ('watcher', 'device_id')
+
+    def __init__(self, watcher, device_id):
+        self.watcher = watcher
+        self.device_id = device_id
+
+    def cancel(self):
+        self.watcher.unwatch(self.device_id)
+
+
+class CooldownWatcher(PrinterCallback):
+    """
+    Wait for devices cooldown thresholds using printer temperature samples.
+
+    The watcher is only registered on the printer while at least one device
+    is waiting. ``on_ready`` is called on ``executor`` with the device once
+    its thresholds are reached. When ``on_estimate`` is given, it is called
+    with the device and the predicted shutdown time whenever the
+    prediction moves by more than ``estimate_step`` seconds.
+    """
+
+    def __init__(self, printer, executor, on_ready, on_estimate=None, estimate_step=5):
+        self._printer = printer
+        self._executor = executor
+        self._on_ready = on_ready
+        self._on_estimate = on_estimate
+        self._estimate_step = estimate_step
+        self._lock = threading.Lock()
+        self._pending = dict()
+        self._estimates = dict()
+        self._registered = False
+        self._releasing = False
+        self.estimator = CooldownEstimator()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def watch(self, device):
+        device_id = str(device.id)
+        with self._lock:
+            self._pending[device_id] = (device, int(device.hotendTemp), int(device.bedTemp))
+            if not self._registered:
+                self.estimator.clear()
+                self.estimator.load_history(self._printer.get_temperature_history())
+                self._printer.register_callback(self)
+                self._registered = True
+        return _CooldownHandle(self, device_id)
+
+    def poke(self):
+        # check without waiting for the next sample, the printer may already
+        # be cold (or not connected at all)
+        self._evaluate(self._printer.get_current_temperatures())
+
+    def unwatch(self, device_id):
+        with self._lock:
+            self._pending.pop(device_id, None)
+            self._estimates.pop(device_id, None)
+            self._release()
+
+    def on_printer_add_temperature(self, data):
+        self.estimator.add(data)
+        self._evaluate(data)
+
+    def _evaluate(self, temps):
+        ready = []
+        estimates = []
+        with self._lock:
+            for device_id, (device, hotend_request, bed_request) in list(self._pending.items()):
+                if is_cooled_down(temps, hotend_request, bed_request):
+                    del self._pending[device_id]
+                    self._estimates.pop(device_id, None)
+                    ready.append(device)
+                elif self._on_estimate is not None:
+                    prediction = self.estimator.predict(hotend_request, bed_request)
+                    eta = prediction[0] if prediction is not None and prediction[1] else None
+                    previous = self._estimates.get(device_id)
+                    if (eta is None) != (previous is None) or \
+                            (eta is not None and abs(eta - previous) >= self._estimate_step):
+                        self._estimates[device_id] = eta
+                        estimates.append((device, eta))
+            self._release()
+
+        for device in ready:
+            self._executor.submit(self._on_ready, device)
+        for device, eta in estimates:
+            self._executor.submit(self._on_estimate, device, eta)
+
+    def _release(self):
+        # called from on_printer_add_temperature too: the printer is iterating
+        # over its callbacks, unregister once it is done
+        if self._registered and not self._pending and not self._releasing:
+            self._releasing = True
+            self._executor.submit(self._unregister)
+
+    def _unregister(self):
+        with self._lock:
+            self._releasing = False
+            # a device may have been watched again in the meantime
+            if self._registered and not self._pending:
+                self._printer.unregister_callback(self)
+                self._registered = False
@@ -1,5 +1,9 @@
+import json
+import re
 import uuid
 
+from octoprint_mqtt_plug.extractors import compile_state_extractor, compile_telemetry_extractor
+
 
 def loadFromDict(data, key, default):
         res = None
@@ -9,7 +13,81 @@ def loadFromDict(data, key, default):
             res = default
         return res
 
+
+def validateField(key, value, default):
+    # values coming from the UI forms may be strings
+    if type(default) == int and type(value) != int:
+        if type(value) == bool:
+            raise ValueError("Invalid value for %s: %r" % (key, value))
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid value for %s: %r" % (key, value))
+    if type(default) == list:
+        if type(value) == str:
+            value = value.split(',')
+        if type(value) not in (list, tuple):
+            raise ValueError("Invalid value for %s: %r" % (key, value))
+        return [str(v).strip() for v in value if str(v).strip()]
+    if type(value) != type(default):
+        raise ValueError("Invalid value for %s: %r" % (key, value))
+    if key == "stateRegex":
+        # compiled by the extractor, a stored invalid pattern would break
+        # the device at startup
+        try:
+            re.compile(value)
+        except re.error as e:
+            raise ValueError("Invalid value for %s: %s" % (key, e))
+    return value
+
+
+def validateData(data):
+    """
+    Validated copy of the known fields of ``data``, unknown keys are ignored.
+    """
+    values = dict()
+    for k in data:
+        if k not in FIELDS or data[k] is None:
+            continue
+        values[k] = validateField(k, data[k], FIELDS[k])
+    return values
+
+
+# Persisted fields and their default values
+FIELDS = dict(
+    deviceName="New device",
+    stateTopic="topic/device/state",
+    switchTopic="topic/device/switch",
+    onValue="ON",
+    offValue="OFF",
+    # auto, value, json or regex
+    stateFormat="auto",
+    statePath="state",
+    stateRegex="",
+    # numeric samples (e.g. the power), empty topic to disable
+    telemetryTopic="",
+    telemetryPath="ENERGY.Power",
+    icon="plug",
+    showNavbarIcon=True,
+    showNavbarName=False,
+    connectionDelay=15,
+    onDone=True,
+    onFailed=False,
+    shutdownType="coldown",
+    stopDelay=60,
+    postponeDelay=60,
+    hotendTemp=50,
+    bedTemp=30,
+    connectPalette2=False,
+    # seconds to wait for the state after a switch command, 0 to disable
+    ackTimeout=5,
+    maxRetries=2,
+    tags=[],
+)
+
+
 class Device:
+    __slots__ = ('id', 'state', 'extractState', 'extractTelemetry', '_serialized', '_json') + tuple(FIELDS)
 
     def __init__(self, data):
         id = loadFromDict(data, "id", uuid.uuid4())
@@ -20,59 +98,41 @@ class Device:
 
         self.id = id
 
-        self.deviceName = loadFromDict(data, "deviceName", "New device")
-        self.stateTopic = loadFromDict(data, "stateTopic", "topic/device/state")
-        self.switchTopic = loadFromDict(data, "switchTopic", "topic/device/switch")
-        self.onValue = loadFromDict(data, "onValue", "ON")
-        self.offValue = loadFromDict(data, "offValue", "OFF")
-
-        self.icon = loadFromDict(data, "icon", "plug")
-        self.showNavbarIcon = loadFromDict(data, "showNavbarIcon", True)
-        self.showNavbarName = loadFromDict(data, "showNavbarName", False)
-
-        self.connectionDelay = loadFromDict(data, "connectionDelay", 15)
-
-        self.onDone = loadFromDict(data, "onDone", True)
-        self.onFailed = loadFromDict(data, "onFailed", False)
-
-        self.shutdownType = loadFromDict(data, "shutdownType", "coldown")
-
-        self.stopDelay = loadFromDict(data, "stopDelay", 60)
-        self.postponeDelay = loadFromDict(data, "postponeDelay", 60)
-
-        self.hotendTemp = loadFromDict(data, "hotendTemp", 50)
-        self.bedTemp = loadFromDict(data, "bedTemp", 30)
-
-        self.connectPalette2 = loadFromDict(data, "connectPalette2", False)
+        for key, default in FIELDS.items():
+            try:
+                value = validateField(key, loadFromDict(data, key, default), default)
+            except ValueError:
+                value = default
+            setattr(self, key, value)
 
         # Unpersistant field
         self.state = False
-
+        self._invalidate()
 
     def update(self, data):
-        for k in data:
-            if k == "id":
-                continue
-            setattr(self, k, data[k])
+        # validate everything before changing anything
+        values = validateData(data)
+
+        for k, value in values.items():
+            setattr(self, k, value)
+        self._invalidate()
+
+    def _invalidate(self):
+        self.extractState = compile_state_extractor(self)
+        self.extractTelemetry = compile_telemetry_extractor(self)
+        self._serialized = None
+        self._json = None
 
     def serialize(self):
-        return dict(
-            id=str(self.id),
-            deviceName=self.deviceName,
-            stateTopic=self.stateTopic,
-            switchTopic=self.switchTopic,
-            onValue=self.onValue,
-            offValue=self.offValue,
-            icon=self.icon,
-            showNavbarIcon=self.showNavbarIcon,
-            showNavbarName=self.showNavbarName,
-            connectionDelay=self.connectionDelay,
-            onDone=self.onDone,
-            onFailed=self.onFailed,
-            shutdownType=self.shutdownType,
-            stopDelay=self.stopDelay,
-            postponeDelay=self.postponeDelay,
-            hotendTemp=self.hotendTemp,
-            bedTemp=self.bedTemp,
-            connectPalette2=self.connectPalette2
-        )
+        # cached, callers must not modify it
+        if self._serialized is None:
+            res = dict(id=str(self.id))
+            for key in FIELDS:
+                res[key] = getattr(self, key)
+            self._serialized = res
+        return self._serialized
+
+    def toJson(self) -> bytes:
+        if self._json is None:
+            self._json = json.dumps(self.serialize(), separators=(',', ':')).encode()
+        return self._json
@@ -0,0 +1,147 @@
+import json
+import re
+
+from octoprint_mqtt_plug import metrics
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+
+        json_loads = ujson.loads
+    except ImportError:
+        json_loads = json.loads
+
+
+def _to_text(message):
+    if type(message) == bytes:
+        return message.decode()
+    return message
+
+
+def _matches(value, on_value):
+    if type(value) == bool:
+        return value
+    return value == on_value
+
+
+def _compile_path(path):
+    keys = []
+    for key in path.split('.'):
+        keys.append(int(key) if key.isdigit() else key)
+    return keys
+
+
+def _lookup(data, keys):
+    for key in keys:
+        if type(key) == int and type(data) == list:
+            if key >= len(data):
+                return None
+        elif type(data) != dict or key not in data:
+            return None
+        data = data[key]
+    return data
+
+
+def compile_value(on_value):
+    on_bytes = on_value.encode()
+
+    def extract(message):
+        if type(message) == bytes:
+            return message == on_bytes
+        return message == on_value
+
+    return extract
+
+
+def compile_json(path, on_value):
+    keys = _compile_path(path or 'state')
+
+    def extract(message):
+        try:
+            data = json_loads(message)
+        except ValueError:
+            metrics.JSON_DECODE_FAILURES.inc()
+            return None
+        value = _lookup(data, keys)
+        if value is None:
+            return None
+        return _matches(value, on_value)
+
+    return extract
+
+
+def compile_regex(pattern, on_value):
+    regex = re.compile(pattern)
+
+    def extract(message):
+        match = regex.search(_to_text(message))
+        if match is None:
+            return None
+        value = match.group(1) if regex.groups else match.group(0)
+        return value == on_value
+
+    return extract
+
+
+def compile_auto(on_value):
+    from_json = compile_json('state', on_value)
+    from_value = compile_value(on_value)
+
+    def extract(message):
+        if len(message) and message[:1] in ('{', b'{'):
+            return from_json(message)
+        return from_value(message)
+
+    return extract
+
+
+def compile_state_extractor(device):
+    """
+    Build the function reading a device state from a state topic payload.
+
+    The function returns True (on), False (off) or None when the payload
+    does not carry a state.
+    """
+    on_value = device.onValue
+    if device.stateFormat == "value":
+        return compile_value(on_value)
+    if device.stateFormat == "json":
+        return compile_json(device.statePath, on_value)
+    if device.stateFormat == "regex":
+        return compile_regex(device.stateRegex, on_value)
+    return compile_auto(on_value)
+
+
+def compile_telemetry_extractor(device):
+    """
+    Build the function reading a numeric sample (e.g. the power) from a
+    telemetry topic payload, None when there is none.
+
+    JSON payloads are read at ``device.telemetryPath``, plain payloads must
+    be a number.
+    """
+    keys = _compile_path(device.telemetryPath or 'ENERGY.Power')
+
+    def extract(message):
+        if not len(message):
+            return None
+        if message[:1] in ('{', b'{', '[', b'['):
+            try:
+                value = _lookup(json_loads(message), keys)
+            except ValueError:
+                metrics.JSON_DECODE_FAILURES.inc()
+                return None
+        else:
+            value = _to_text(message)
+        if type(value) == bool:
+            return None
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    return extract
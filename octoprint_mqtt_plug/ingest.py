@@ -0,0 +1,118 @@
+import collections
+import logging
+import threading
+
+
+class MessageIngest:
+    """
+    Bounded queue between the MQTT client thread and message processing.
+
+    ``put`` only stores the message: a message waiting with the same key is
+    superseded by the newer one, and when ``maxsize`` messages are waiting
+    the oldest one is dropped (``overflow``). ``control`` messages (commands)
+    are never dropped nor counted in ``maxsize``. A worker thread hands the
+    pending messages to ``handler`` in batches of at most ``batch_size``.
+    """
+
+    def __init__(self, handler, maxsize=1000, batch_size=100, name="mqtt_plug.ingest"):
+        self._handler = handler
+        self._maxsize = maxsize
+        self._batch_size = batch_size
+        self._name = name
+        self._logger = logging.getLogger("octoprint.plugins.mqtt_plug.ingest")
+        self._condition = threading.Condition()
+        self._pending = collections.OrderedDict()
+        self._controls = set()
+        self._thread = None
+        self._running = False
+
+        self.received = 0
+        self.superseded = 0
+        self.overflow = 0
+        self.batches = 0
+
+    @property
+    def depth(self):
+        return len(self._pending)
+
+    @property
+    def dropped(self):
+        return self.superseded + self.overflow
+
+    def stats(self):
+        return dict(
+            depth=self.depth,
+            controls=len(self._controls),
+            maxsize=self._maxsize,
+            received=self.received,
+            superseded=self.superseded,
+            overflow=self.overflow,
+            dropped=self.dropped,
+            batches=self.batches
+        )
+
+    def put(self, key, item, control=False):
+        with self._condition:
+            self.received += 1
+            if key in self._pending:
+                self.superseded += 1
+            elif not control and len(self._pending) - len(self._controls) >= self._maxsize:
+                oldest = next(k for k in self._pending if k not in self._controls)
+                del self._pending[oldest]
+                self.overflow += 1
+            if control:
+                self._controls.add(key)
+            self._pending[key] = item
+            self._condition.notify()
+
+    def drain(self):
+        """
+        Process everything pending on the calling thread.
+        """
+        while True:
+            batch = self._take()
+            if not batch:
+                return
+            self._process(batch)
+
+    def start(self):
+        with self._condition:
+            if self._thread is not None:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _take(self):
+        with self._condition:
+            batch = []
+            while self._pending and len(batch) < self._batch_size:
+                key, item = self._pending.popitem(last=False)
+                self._controls.discard(key)
+                batch.append(item)
+            return batch
+
+    def _process(self, batch):
+        self.batches += 1
+        try:
+            self._handler(batch)
+        except Exception:
+            self._logger.exception("Failed to process %d mqtt messages", len(batch))
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and not self._pending:
+                    self._condition.wait()
+                if not self._running:
+                    return
+            self._process(self._take())
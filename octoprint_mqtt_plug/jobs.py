@@ -0,0 +1,66 @@
+import collections
+import threading
+import uuid
+
+
+class Job:
+    """
+    Group of futures started by one API call, pollable by id.
+    """
+
+    def __init__(self, name, futures):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.futures = futures
+
+    @staticmethod
+    def _future_state(future):
+        if future.cancelled():
+            return "cancelled"
+        if not future.done():
+            return "running" if future.running() else "pending"
+        if future.exception() is not None:
+            return "failed"
+        return "done"
+
+    def done(self):
+        return all(future.done() for future in self.futures.values())
+
+    def status(self):
+        steps = dict()
+        for step, future in self.futures.items():
+            steps[step] = self._future_state(future)
+
+        states = set(steps.values())
+        if not states or states <= {"done", "cancelled"}:
+            state = "done"
+        elif "failed" in states and self.done():
+            state = "failed"
+        elif states & {"running", "done", "failed"}:
+            state = "running"
+        else:
+            state = "pending"
+
+        return dict(id=self.id, name=self.name, state=state, steps=steps)
+
+
+class JobRegistry:
+    """
+    Keep the last ``size`` jobs.
+    """
+
+    def __init__(self, size=100):
+        self._size = size
+        self._lock = threading.Lock()
+        self._jobs = collections.OrderedDict()
+
+    def add(self, name, futures) -> Job:
+        job = Job(name, futures)
+        with self._lock:
+            self._jobs[job.id] = job
+            while len(self._jobs) > self._size:
+                self._jobs.popitem(last=False)
+        return job
+
+    def get(self, job_id) -> Job or None:
+        return self._jobs.get(job_id)
@@ -0,0 +1,58 @@
+import json
+import logging
+import os
+
+FORMAT_VERSION = 1
+
+
+class LastStateFile:
+    """
+    Last reported state of every device, kept in the plugin data folder so
+    that a restart does not show every plug as off until it publishes.
+
+    The file is compact JSON: ``{"v": 1, "states": {id: [state, since]}}``
+    with ``since`` the epoch time of the last state change. It is replaced
+    atomically so a crash while writing keeps the previous snapshot.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._logger = logging.getLogger("octoprint.plugins.mqtt_plug.laststate")
+
+    def load(self):
+        """
+        Return ``{device_id: (state, since)}``, empty if the file is
+        missing or unreadable.
+        """
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return dict()
+        except (OSError, ValueError):
+            self._logger.exception("Failed to read %s", self.path)
+            return dict()
+
+        if type(data) != dict or data.get("v") != FORMAT_VERSION or type(data.get("states")) != dict:
+            self._logger.warning("Ignore %s, unknown format", self.path)
+            return dict()
+
+        res = dict()
+        for device_id, entry in data["states"].items():
+            if type(entry) == list and len(entry) == 2:
+                res[device_id] = (bool(entry[0]), entry[1])
+        return res
+
+    def write(self, states):
+        """
+        Write the ``{device_id: entry}`` snapshot of the StateStore,
+        devices which never reported a state are left out.
+        """
+        data = dict(v=FORMAT_VERSION, states=dict(
+            (device_id, [1 if entry['state'] else 0, entry['since']])
+            for device_id, entry in states.items() if entry['since'] is not None
+        ))
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(data, f, separators=(',', ':'))
+        os.replace(tmp, self.path)
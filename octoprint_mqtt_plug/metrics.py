@@ -0,0 +1,164 @@
+import bisect
+import time
+
+
+class Counter:
+    """
+    Monotonic counter, optionally split by one label.
+
+    Increments are not locked: a lost increment under contention is an
+    acceptable price for keeping the hot paths cheap.
+    """
+
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = dict()
+
+    def inc(self, value=1, label=None):
+        self.values[label] = self.values.get(label, 0) + value
+
+    def get(self, label=None):
+        return self.values.get(label, 0)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        if not self.values:
+            lines.append("%s 0" % self.name)
+        for label, value in sorted(self.values.items(), key=lambda item: str(item[0])):
+            if label is None:
+                lines.append("%s %s" % (self.name, value))
+            else:
+                lines.append('%s{%s="%s"} %s' % (self.name, self.label, label, value))
+        return lines
+
+
+class Gauge:
+    """
+    Value computed by ``fn`` when the metrics are rendered.
+    """
+
+    def __init__(self, name, help, fn=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def render(self):
+        value = self.fn() if self.fn is not None else 0
+        return ["# HELP %s %s" % (self.name, self.help), "# TYPE %s gauge" % self.name,
+                "%s %s" % (self.name, value)]
+
+
+class Histogram:
+
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('%s_bucket{le="%s"} %d' % (self.name, bound, cumulative))
+        lines.append('%s_bucket{le="+Inf"} %d' % (self.name, self.count))
+        lines.append("%s_sum %s" % (self.name, self.sum))
+        lines.append("%s_count %d" % (self.name, self.count))
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Collection of metrics rendered in the Prometheus text format.
+
+    Measurements that are not free (like serialising a payload to know its
+    size) should only be done while ``active``, i.e. while somebody scraped
+    the metrics in the last ``active_window`` seconds.
+    """
+
+    def __init__(self, active_window=600):
+        self.metrics = []
+        self.active_window = active_window
+        self.lastScrape = None
+
+    @property
+    def active(self):
+        return self.lastScrape is not None and time.monotonic() - self.lastScrape < self.active_window
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label=None) -> Counter:
+        return self.register(Counter(name, help, label))
+
+    def gauge(self, name, help, fn=None) -> Gauge:
+        return self.register(Gauge(name, help, fn))
+
+    def histogram(self, name, help, buckets) -> Histogram:
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self):
+        self.lastScrape = time.monotonic()
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+SIZE_BUCKETS = (128, 512, 1024, 4096, 16384, 65536, 262144)
+
+REGISTRY = MetricsRegistry()
+
+MESSAGES_RECEIVED = REGISTRY.counter(
+    "mqtt_plug_messages_received_total", "MQTT messages received by on_mqtt_sub")
+MESSAGES_MATCHED = REGISTRY.counter(
+    "mqtt_plug_messages_matched_total", "MQTT messages matching a device state topic or a control topic")
+MESSAGE_SECONDS = REGISTRY.histogram(
+    "mqtt_plug_message_handling_seconds", "Time spent handling one MQTT message", LATENCY_BUCKETS)
+JSON_DECODE_FAILURES = REGISTRY.counter(
+    "mqtt_plug_json_decode_failures_total", "MQTT payloads that could not be decoded as JSON")
+PUBLISHES = REGISTRY.counter(
+    "mqtt_plug_publishes_total", "MQTT messages published", label="kind")
+PUBLISHES_COLLAPSED = REGISTRY.counter(
+    "mqtt_plug_publishes_collapsed_total", "MQTT messages superseded while buffered or identical to the retained one",
+    label="kind")
+PUBLISHES_DROPPED = REGISTRY.counter(
+    "mqtt_plug_publishes_dropped_total", "MQTT messages dropped (buffer full or no base topic)", label="kind")
+UI_PUSHES = REGISTRY.counter(
+    "mqtt_plug_ui_pushes_total", "Plugin messages pushed to the UI", label="type")
+UI_PUSH_BYTES = REGISTRY.histogram(
+    "mqtt_plug_ui_push_bytes", "Size of plugin messages pushed to the UI (only measured while scraped)",
+    SIZE_BUCKETS)
+SWITCH_ACK_SECONDS = REGISTRY.histogram(
+    "mqtt_plug_switch_ack_seconds", "Time between a switch command and the matching device state",
+    (0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60))
+SWITCH_RETRIES = REGISTRY.counter(
+    "mqtt_plug_switch_retries_total", "Switch commands sent again after no acknowledgement")
+SWITCH_FAILURES = REGISTRY.counter(
+    "mqtt_plug_switch_failures_total", "Switch commands never acknowledged")
+SETTINGS_SAVES = REGISTRY.counter(
+    "mqtt_plug_settings_saves_total", "Device settings written to config.yaml")
+
+# computed when rendered, ``fn`` is set by the plugin
+ACTIVE_TIMERS = REGISTRY.gauge(
+    "mqtt_plug_active_timers", "Scheduled shutdowns and cooldown waits (stopTimer and stopCooldown)")
+SCHEDULED_TASKS = REGISTRY.gauge(
+    "mqtt_plug_scheduled_tasks", "Tasks pending in the scheduler")
+INGEST_DEPTH = REGISTRY.gauge(
+    "mqtt_plug_ingest_queue_depth", "MQTT messages waiting in the ingestion queue")
+INGEST_DROPPED = REGISTRY.gauge(
+    "mqtt_plug_ingest_dropped", "MQTT messages superseded or dropped by the ingestion queue")
+PUBLISH_BUFFER = REGISTRY.gauge(
+    "mqtt_plug_publish_buffer", "MQTT messages waiting for the broker connection")
@@ -0,0 +1,68 @@
+import logging
+import threading
+
+
+class SettingsPersister:
+    """
+    Write-behind persistence of the device settings (or anything written
+    by ``write``, ``name`` is used in logs).
+
+    Changes are only marked dirty, the write happens on the scheduler once
+    no other change came in for ``delay`` seconds (at most ``max_delay``
+    after the first one), so bursts of edits are saved once. OctoPrint's
+    settings can only be written as a whole, so ``write`` always saves
+    everything.
+    """
+
+    def __init__(self, scheduler, write, delay=1.0, max_delay=5.0, name="settings"):
+        self._scheduler = scheduler
+        self._write = write
+        self._name = name
+        self._delay = delay
+        self._max_delay = max_delay
+        self._logger = logging.getLogger("octoprint.plugins.mqtt_plug.persister")
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._dirty = False
+        self._task = None
+        self._first = None
+
+        self.writes = 0
+
+    @property
+    def dirty(self):
+        return self._dirty
+
+    def markDirty(self):
+        with self._lock:
+            self._dirty = True
+            now = self._scheduler.time()
+            if self._first is None:
+                self._first = now
+            if self._task is not None:
+                self._task.cancel()
+            delay = min(self._delay, max(0, self._first + self._max_delay - now))
+            self._task = self._scheduler.schedule(delay, self.flush)
+
+    def flush(self):
+        with self._write_lock:
+            with self._lock:
+                if self._task is not None:
+                    self._task.cancel()
+                    self._task = None
+                self._first = None
+                dirty = self._dirty
+                self._dirty = False
+
+            if not dirty:
+                return False
+
+            try:
+                self._write()
+                self.writes += 1
+            except Exception:
+                self._logger.exception("Failed to save %s", self._name)
+                with self._lock:
+                    self._dirty = True
+                return False
+            return True
@@ -0,0 +1,149 @@
+import collections
+import logging
+import threading
+
+from octoprint_mqtt_plug import metrics
+
+
+class Publisher:
+    """
+    Outgoing MQTT messages.
+
+    Messages are sent right away unless ``is_connected()`` is false or
+    ``publish`` refuses them (returns False). They then wait in a buffer of
+    at most ``maxsize`` messages where a newer message for the same topic
+    supersedes (collapses) the waiting one and the oldest is dropped when
+    full. The buffer is flushed on ``poke`` or every ``retry_delay`` seconds.
+
+    ``kind`` is the message class (``switch``, ``plugin``), used for the QoS
+    (``qos`` dict) and the counters. With ``dedupe`` a retained message
+    identical to the last one sent on its topic is not sent again, until the
+    connection is lost.
+    """
+
+    def __init__(self, scheduler, publish, is_connected, maxsize=500, retry_delay=5.0, qos=None):
+        self._scheduler = scheduler
+        self._publish = publish
+        self._is_connected = is_connected
+        self._maxsize = maxsize
+        self._retry_delay = retry_delay
+        self._logger = logging.getLogger("octoprint.plugins.mqtt_plug.publisher")
+        self._lock = threading.Lock()
+        self._buffer = collections.OrderedDict()
+        self._retained = dict()
+        self._retry = None
+        self._flushQueued = False
+        self._online = True
+        self.qos = dict(qos or dict())
+
+        self.sent = collections.Counter()
+        self.collapsed = collections.Counter()
+        self.dropped = collections.Counter()
+
+    @property
+    def buffered(self):
+        return len(self._buffer)
+
+    def stats(self):
+        return dict(
+            connected=bool(self._is_connected()),
+            buffered=self.buffered,
+            maxsize=self._maxsize,
+            qos=self.qos,
+            sent=dict(self.sent),
+            collapsed=dict(self.collapsed),
+            dropped=dict(self.dropped)
+        )
+
+    def publish(self, kind, topic, payload, retained=False, dedupe=False):
+        with self._lock:
+            self._checkConnection()
+            if dedupe and retained and topic not in self._buffer and self._retained.get(topic) == payload:
+                self._count(self.collapsed, metrics.PUBLISHES_COLLAPSED, kind)
+                return
+            if not self._buffer and self._is_connected() and self._send(kind, topic, payload, retained):
+                return
+            self._enqueue(kind, topic, payload, retained)
+
+    def drop(self, kind):
+        """
+        Count a message which could not even be addressed.
+        """
+        self._count(self.dropped, metrics.PUBLISHES_DROPPED, kind)
+
+    def poke(self):
+        with self._lock:
+            if not self._buffer or self._flushQueued:
+                return
+            self._flushQueued = True
+        self._scheduler.call_soon(self.flush)
+
+    def flush(self):
+        with self._lock:
+            self._flushQueued = False
+            if self._retry is not None:
+                self._retry.cancel()
+                self._retry = None
+            self._checkConnection()
+            while self._buffer and self._is_connected():
+                topic, (kind, payload, retained) = next(iter(self._buffer.items()))
+                if not self._send(kind, topic, payload, retained):
+                    break
+                del self._buffer[topic]
+            if self._buffer:
+                self._scheduleRetry()
+            return len(self._buffer)
+
+    def clear(self):
+        with self._lock:
+            self._buffer.clear()
+            self._retained.clear()
+            if self._retry is not None:
+                self._retry.cancel()
+                self._retry = None
+
+    def _send(self, kind, topic, payload, retained):
+        try:
+            res = self._publish(topic, payload, retained=retained, qos=self.qos.get(kind, 0))
+        except Exception:
+            self._logger.exception("Failed to publish on %s", topic)
+            return False
+        if res is False:
+            # the helper could not hand it to the client, the broker may
+            # come back without the retained messages
+            self._online = False
+            self._retained.clear()
+            return False
+        self._online = True
+        if retained:
+            self._retained[topic] = payload
+        else:
+            self._retained.pop(topic, None)
+        self._count(self.sent, metrics.PUBLISHES, kind)
+        return True
+
+    def _checkConnection(self):
+        connected = bool(self._is_connected())
+        if connected and not self._online:
+            # reconnected, retained messages have to be sent again
+            self._retained.clear()
+        self._online = connected
+
+    def _enqueue(self, kind, topic, payload, retained):
+        if topic in self._buffer:
+            del self._buffer[topic]
+            self._count(self.collapsed, metrics.PUBLISHES_COLLAPSED, kind)
+        elif len(self._buffer) >= self._maxsize:
+            _, (oldKind, _, _) = self._buffer.popitem(last=False)
+            self._count(self.dropped, metrics.PUBLISHES_DROPPED, oldKind)
+        self._buffer[topic] = (kind, payload, retained)
+        self._scheduleRetry()
+
+    def _scheduleRetry(self):
+        if self._retry is None:
+            self._retry = self._scheduler.schedule(self._retry_delay, self.flush)
+
+    @staticmethod
+    def _count(counter, metric, kind):
+        counter[kind] += 1
+        metric.inc(label=kind)
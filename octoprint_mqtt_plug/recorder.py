@@ -0,0 +1,125 @@
+import base64
+import json
+import logging
+import os
+import threading
+import time
+
+
+def encode_record(t, topic, payload, retain):
+    """
+    One line of the capture: ``[t, topic, payload, retain]``, binary
+    payloads are base64 encoded and flagged with a fifth ``1`` item.
+    """
+    record = [round(t, 6), topic, payload, bool(retain)]
+    if type(payload) == bytes:
+        try:
+            record[2] = payload.decode()
+        except UnicodeDecodeError:
+            record[2] = base64.b64encode(payload).decode()
+            record.append(1)
+    return json.dumps(record, separators=(',', ':'))
+
+
+def decode_line(line):
+    """
+    ``("header", dict)`` or ``("message", (t, topic, payload, retain))``
+    with the payload as bytes, like the MQTT client gives it.
+    """
+    data = json.loads(line)
+    if type(data) == dict:
+        return "header", data
+    t, topic, payload, retain = data[:4]
+    if len(data) > 4 and data[4]:
+        payload = base64.b64decode(payload)
+    else:
+        payload = payload.encode()
+    return "message", (t, topic, payload, retain)
+
+
+class TrafficRecorder:
+    """
+    Append the received MQTT messages to a line-delimited JSON file, for
+    replaying them with ``benchmarks/replay.py``.
+
+    Each recording session starts with a header line (a JSON object) holding
+    the devices and base topic, then one ``encode_record`` line per message.
+    Writes are buffered and flushed at most every ``flush_interval`` seconds;
+    recording stops once the file reaches ``max_bytes`` or on a write error,
+    ``record`` never raises (it runs on the MQTT client thread).
+    """
+
+    def __init__(self, path, max_bytes=50 * 1024 * 1024, flush_interval=1.0):
+        self.path = path
+        self._max_bytes = max_bytes
+        self._flush_interval = flush_interval
+        self._logger = logging.getLogger("octoprint.plugins.mqtt_plug.recorder")
+        self._lock = threading.Lock()
+        self._file = None
+        self._size = 0
+        self._lastFlush = 0
+
+        self.recorded = 0
+
+    @property
+    def recording(self):
+        return self._file is not None
+
+    def start(self, header):
+        with self._lock:
+            if self._file is not None:
+                return
+            self._size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+            if self._size >= self._max_bytes:
+                self._logger.warning("%s is full, MQTT traffic is not recorded", self.path)
+                return
+            try:
+                self._file = open(self.path, "a", buffering=65536)
+                self._write(json.dumps(header, separators=(',', ':')))
+            except OSError:
+                self._logger.exception("Failed to record MQTT traffic in %s", self.path)
+                self._close()
+                return
+            self._logger.info("Record MQTT traffic in %s", self.path)
+
+    def record(self, topic, payload, retain=False):
+        if self._file is None:
+            return
+        try:
+            line = encode_record(time.time(), topic, payload, retain)
+        except (TypeError, ValueError):
+            self._logger.exception("Failed to encode the MQTT message of %s", topic)
+            return
+        with self._lock:
+            if self._file is None:
+                return
+            try:
+                self._write(line)
+                self.recorded += 1
+                if self._size >= self._max_bytes:
+                    self._logger.warning("%s is full, stop recording MQTT traffic", self.path)
+                    self._close()
+                elif time.monotonic() - self._lastFlush > self._flush_interval:
+                    self._file.flush()
+                    self._lastFlush = time.monotonic()
+            except OSError:
+                self._logger.exception("Failed to write %s, stop recording MQTT traffic", self.path)
+                self._close()
+
+    def stop(self):
+        with self._lock:
+            self._close()
+
+    def _write(self, line):
+        self._file.write(line + "\n")
+        self._size += len(line) + 1
+
+    def _close(self):
+        if self._file is not None:
+            file = self._file
+            self._file = None
+            try:
+                file.close()
+            except OSError:
+                # buffered lines are lost, nothing more to do
+                pass
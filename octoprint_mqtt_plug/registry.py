@@ -0,0 +1,87 @@
+import uuid
+
+from octoprint_mqtt_plug.device import Device
+
+
+class DeviceRegistry:
+    """
+    Ordered collection of devices indexed by id.
+
+    Devices can be looked up by their UUID or by its string form, iteration
+    follows insertion order (used for the navbar entries).
+    """
+
+    def __init__(self, devices=None):
+        self._devices = dict()
+        self._keys = dict()
+        self._names = dict()
+        self._namesVersion = None
+        # bumped on every configuration change
+        self.version = 0
+        if devices is not None:
+            for dev in devices:
+                self.add(dev)
+
+    def __iter__(self):
+        return iter(list(self._devices.values()))
+
+    def __len__(self):
+        return len(self._devices)
+
+    def __contains__(self, device):
+        return device is not None and self._devices.get(device.id) is device
+
+    def add(self, device: Device):
+        self._devices[device.id] = device
+        self._keys[device.id] = device
+        self._keys[str(device.id)] = device
+        self.version += 1
+
+    def remove(self, device: Device):
+        if self._devices.pop(device.id, None) is None:
+            return
+        self._keys.pop(device.id, None)
+        self._keys.pop(str(device.id), None)
+        self.version += 1
+
+    def clear(self):
+        self._devices = dict()
+        self._keys = dict()
+        self.version += 1
+
+    def touch(self):
+        self.version += 1
+
+    def withName(self, name) -> Device or None:
+        """
+        Device by name, case insensitive, the first one if names are shared.
+        """
+        # names change with updates, the index is rebuilt after any change
+        if self._namesVersion != self.version:
+            names = dict()
+            for dev in reversed(list(self._devices.values())):
+                names[str(dev.deviceName).strip().lower()] = dev
+            self._names = names
+            self._namesVersion = self.version
+        return self._names.get(str(name).strip().lower())
+
+    def withTag(self, tag):
+        return [dev for dev in list(self._devices.values()) if tag in dev.tags]
+
+    def serialize(self):
+        return [dev.serialize() for dev in list(self._devices.values())]
+
+    def toJson(self) -> bytes:
+        return b'[' + b','.join([dev.toJson() for dev in list(self._devices.values())]) + b']'
+
+    def get(self, id) -> Device or None:
+        if id is None:
+            return None
+        dev = self._keys.get(id)
+        if dev is None and type(id) == str:
+            # accept non canonical string forms (uppercase, braces, ...)
+            try:
+                dev = self._keys.get(uuid.UUID(id))
+            except ValueError:
+                return None
+        return dev
@@ -0,0 +1,106 @@
+import collections
+import threading
+import types
+
+Schedule = collections.namedtuple('Schedule', ('shutdownAt', 'stopTimer', 'stopCooldown'))
+Schedule.__doc__ = """
+Planned shutdown of a device: ``shutdownAt`` (epoch seconds, the deadline in
+time mode or the estimate in cooldown mode), the ``stopTimer`` task of the
+time mode and the ``stopCooldown`` handle of the cooldown mode.
+"""
+
+NOTHING_PLANNED = Schedule(None, None, None)
+
+
+class ScheduleStore:
+    """
+    Planned shutdowns keyed by device id string.
+
+    Writers are serialised by one lock and replace the whole mapping (copy
+    on write), so readers get an immutable snapshot without locking, which
+    stays consistent while it is serialised. ``version`` is bumped on every
+    actual change.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = types.MappingProxyType(dict())
+        self.version = 0
+
+    def snapshot(self):
+        return self._entries
+
+    def get(self, device_id) -> Schedule:
+        return self._entries.get(device_id, NOTHING_PLANNED)
+
+    def set(self, device_id, **fields) -> Schedule:
+        with self._lock:
+            return self._put(device_id, self.get(device_id)._replace(**fields))
+
+    def update(self, device_id, fn) -> Schedule:
+        """
+        Replace the entry by ``fn(entry)``, called with the lock held.
+        """
+        with self._lock:
+            return self._put(device_id, fn(self.get(device_id)))
+
+    def swap(self, device_id, field, expected, value) -> bool:
+        """
+        Set ``field`` only if it is still ``expected``.
+        """
+        with self._lock:
+            current = self.get(device_id)
+            if getattr(current, field) is not expected:
+                return False
+            self._put(device_id, current._replace(**{field: value}))
+            return True
+
+    def postpone(self, device_id, delay, now) -> int:
+        """
+        Move the shutdown ``delay`` seconds later (from ``now`` if none is
+        planned), return the new ``shutdownAt``.
+        """
+        with self._lock:
+            current = self.get(device_id)
+            shutdownAt = (current.shutdownAt if current.shutdownAt is not None else now) + delay
+            self._put(device_id, current._replace(shutdownAt=shutdownAt))
+            return shutdownAt
+
+    def cancel(self, device_id, keep_deadline=False) -> Schedule:
+        """
+        Cancel the timer and cooldown wait of a device and return what was
+        planned. With ``keep_deadline`` the time mode deadline stays, so that
+        it can be postponed.
+        """
+        with self._lock:
+            current = self.get(device_id)
+            keep = keep_deadline and current.stopCooldown is None
+            self._put(device_id, Schedule(current.shutdownAt if keep else None, None, None))
+
+        for handle in (current.stopTimer, current.stopCooldown):
+            if handle is not None:
+                handle.cancel()
+        return current
+
+    def clear(self):
+        with self._lock:
+            entries = self._entries
+            self._entries = types.MappingProxyType(dict())
+            self.version += 1
+
+        for entry in entries.values():
+            for handle in (entry.stopTimer, entry.stopCooldown):
+                if handle is not None:
+                    handle.cancel()
+
+    def _put(self, device_id, entry) -> Schedule:
+        if entry == self.get(device_id):
+            return entry
+        entries = dict(self._entries)
+        if entry == NOTHING_PLANNED:
+            entries.pop(device_id, None)
+        else:
+            entries[device_id] = entry
+        self._entries = types.MappingProxyType(entries)
+        self.version += 1
+        return entry
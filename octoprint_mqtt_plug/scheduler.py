@@ -0,0 +1,129 @@
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+class ScheduledTask:
+    __slots__ = ('when', 'fn', 'args', 'kwargs', 'cancelled')
+
+    def __init__(self, when, fn, args, kwargs):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def remaining(self):
+        return max(0.0, self.when - time.monotonic())
+
+
+class Scheduler:
+    """
+    Run delayed callbacks from a single thread.
+
+    Pending tasks are kept in a heap ordered by due time, and due callbacks
+    are handed to ``executor`` so a slow callback never delays the others.
+    Tasks returned by ``schedule`` can be cancelled like a ``threading.Timer``.
+    """
+
+    def __init__(self, executor, name="mqtt_plug.scheduler"):
+        self._executor = executor
+        self._name = name
+        self._logger = logging.getLogger("octoprint.plugins.mqtt_plug.scheduler")
+        self._condition = threading.Condition()
+        self._heap = []
+        self._counter = itertools.count()
+        self._thread = None
+        self._running = False
+
+    def __len__(self):
+        with self._condition:
+            return sum(1 for entry in self._heap if not entry[2].cancelled)
+
+    @staticmethod
+    def time():
+        return time.monotonic()
+
+    def schedule(self, delay, fn, *args, **kwargs) -> ScheduledTask:
+        task = ScheduledTask(time.monotonic() + max(0, delay), fn, args, kwargs)
+        with self._condition:
+            heapq.heappush(self._heap, (task.when, next(self._counter), task))
+            if self._thread is None:
+                self._start()
+            if self._heap[0][2] is task:
+                self._condition.notify()
+        return task
+
+    def call_soon(self, fn, *args, **kwargs):
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def submit_later(self, delay, fn, *args, **kwargs) -> concurrent.futures.Future:
+        """
+        Like ``schedule`` but return a future of ``fn`` result, cancelling the
+        future before it runs cancels the call.
+        """
+        future = concurrent.futures.Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+        task = self.schedule(delay, run)
+        future.add_done_callback(lambda f: task.cancel() if f.cancelled() else None)
+        return future
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._heap = []
+            self._condition.notify()
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+
+    def _start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name=self._name, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running:
+                    while self._heap and self._heap[0][2].cancelled:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    timeout = self._heap[0][0] - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    self._condition.wait(timeout)
+                if not self._running:
+                    return
+                task = heapq.heappop(self._heap)[2]
+
+            try:
+                self._executor.submit(self._execute, task)
+            except RuntimeError:
+                # executor has been shut down
+                return
+
+    def _execute(self, task):
+        if task.cancelled:
+            return
+        try:
+            task.fn(*task.args, **task.kwargs)
+        except Exception:
+            self._logger.exception("Scheduled task %r failed", task.fn)
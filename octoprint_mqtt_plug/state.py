@@ -0,0 +1,104 @@
+import threading
+import time
+
+
+class StateStore:
+    """
+    Last known state of every device, keyed by device id string.
+
+    Every change bumps a version number so that clients can apply deltas
+    in order. Readers get a cached snapshot which is only rebuilt after a
+    change.
+
+    Entries hold the ``state``, the ``pending`` command flag, ``since`` (the
+    epoch time of the last state change) and ``stale``, set for states
+    restored from a previous run until the device reports again.
+
+    The time a device last reported (even an unchanged state) is tracked
+    apart with ``seen``, it does not bump the version.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = dict()
+        self._seen = dict()
+        self._snapshot = None
+        self.version = 0
+        self.seenCount = 0
+
+    def set(self, device_id, state=None, pending=None) -> bool:
+        """
+        Update the state and/or the pending flag (None keeps the current
+        value), return True if something changed.
+
+        A reported state clears the stale flag.
+        """
+        with self._lock:
+            current = self._states.get(device_id)
+            if current is None:
+                current = dict(state=False, pending=False, since=None, stale=False)
+            entry = dict(current)
+            if state is not None:
+                entry['stale'] = False
+                if state != current['state'] or current['since'] is None:
+                    entry['state'] = state
+                    entry['since'] = time.time()
+            if pending is not None:
+                entry['pending'] = pending
+            if entry == current and device_id in self._states:
+                return False
+            self.version += 1
+            self._states[device_id] = entry
+            self._snapshot = None
+            return True
+
+    def restore(self, device_id, state, since):
+        """
+        Set a state known from a previous run, marked stale.
+        """
+        with self._lock:
+            self._states[device_id] = dict(state=state, pending=False, since=since, stale=True)
+            self.version += 1
+            self._snapshot = None
+
+    def get(self, device_id):
+        return self._states.get(device_id)
+
+    def seen(self, device_id):
+        self._seen[device_id] = time.time()
+        self.seenCount += 1
+
+    def lastSeen(self, device_id):
+        return self._seen.get(device_id)
+
+    def remove(self, device_id):
+        with self._lock:
+            self._seen.pop(device_id, None)
+            if self._states.pop(device_id, None) is not None:
+                self.version += 1
+                self._snapshot = None
+
+    def clear(self):
+        with self._lock:
+            self._states = dict()
+            self._seen = dict()
+            self._snapshot = None
+            self.version += 1
+
+    def snapshot(self):
+        return self.versioned_snapshot()[1]
+
+    def versioned_snapshot(self):
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = (self.version, dict(self._states))
+                self._snapshot = snapshot
+        return snapshot
+
+    def delta(self, device_ids):
+        with self._lock:
+            changes = dict()
+            for device_id in device_ids:
+                changes[device_id] = self._states.get(device_id)
+            return dict(version=self.version, changes=changes)
@@ -23,7 +23,8 @@ $(function () {
         });
 
         self.navInfo = ko.observable({
-            state: false
+            state: {},
+            version: 0
         });
 
         self.reloadRequired = ko.observable(false);
@@ -36,7 +37,7 @@ $(function () {
         self.iconClass = function (dev) {
             //debugger;
             let info = self.navInfo().state[dev.id()];
-            return "fa fa-" + dev.icon() + " state-icon " + (info && info.state ? 'state-on' : 'state-off');
+            return "fa fa-" + dev.icon() + " state-icon " + (info && info.state ? 'state-on' : 'state-off') + (info && info.pending ? ' state-pending' : '') + (info && info.stale ? ' state-stale' : '');
         };
 
 
@@ -64,44 +65,103 @@ $(function () {
             return self.settings.getLocalData().plugins.mqtt_plug.devices.length > 0;
         };
 
+        // last message applied, pushes are numbered by the server per boot
+        self.syncBoot = null;
+        self.lastSeq = null;
+        self.syncing = false;
+        self.syncPending = [];
+
         self.onDataUpdaterPluginMessage = function (plugin, msg) {
-            if (plugin == 'mqtt_plug') {
-                if (msg.type == 'sidebar') {
-                    self.onSidebarInfo(msg.payload);
-                } else if (msg.type == 'navbar') {
-                    self.navInfo(msg.payload);
-                }
+            if (plugin != 'mqtt_plug') {
+                return;
+            }
+            if (self.syncing) {
+                self.syncPending.push(msg);
+                return;
+            }
+            if (msg.seq === undefined) {
+                self.applyMessage(msg);
+            } else if (self.lastSeq === null || msg.boot !== self.syncBoot || msg.seq > self.lastSeq + 1) {
+                // missed something
+                self.sync();
+            } else if (msg.seq == self.lastSeq + 1) {
+                self.applyMessage(msg);
+                self.lastSeq = msg.seq;
             }
         }
 
-        self.onStartupComplete = function (event) {
-            self.getSideBarInfo();
-            self.getNavbarInfo();
-            setInterval(self.getNavbarInfo, 60 * 1000);
-
+        self.onDataUpdaterReconnect = function () {
+            self.sync();
         }
 
-
-        self.onWizardDetails = function () {
-            self.setDefaultDeviceDialogValue($('#mqttPlugWizardForm'))
+        self.applyMessage = function (msg) {
+            if (msg.type == 'sidebar') {
+                self.onSidebarInfo(msg.payload);
+            } else if (msg.type == 'navbar') {
+                self.navInfo(msg.payload);
+            } else if (msg.type == 'state') {
+                self.onStateDelta(msg.payload);
+            }
         }
 
-        self.getSideBarInfo = function () {
+        self.sync = function () {
+            if (self.syncing) {
+                return;
+            }
+            self.syncing = true;
+            let data = {};
+            if (self.lastSeq !== null) {
+                data = {since: self.lastSeq, boot: self.syncBoot};
+            }
             $.ajax({
-                url: BASEURL + "plugin/mqtt_plug/sidebar/info",
+                url: BASEURL + "plugin/mqtt_plug/sync",
                 type: "GET",
-                dataType: "json"
-            }).done(self.onSidebarInfo);
-        };
+                dataType: "json",
+                data: data
+            }).done(function (res) {
+                if (res.snapshot) {
+                    self.onSidebarInfo(res.snapshot.sidebar);
+                    self.navInfo(res.snapshot.navbar);
+                } else {
+                    res.messages.forEach(self.applyMessage);
+                }
+                self.syncBoot = res.boot;
+                self.lastSeq = res.seq;
+            }).always(function () {
+                self.syncing = false;
+                let pending = self.syncPending;
+                self.syncPending = [];
+                pending.forEach(function (msg) {
+                    self.onDataUpdaterPluginMessage('mqtt_plug', msg);
+                });
+            });
+        }
 
-        self.getNavbarInfo = function () {
-            $.ajax({
-                url: BASEURL + "plugin/mqtt_plug/navbar/info",
-                type: "GET",
-                dataType: "json"
-            }).done(self.navInfo);
+        self.onStateDelta = function (delta) {
+            let info = self.navInfo();
+            if (delta.version <= info.version) {
+                return;
+            }
+            let state = Object.assign({}, info.state);
+            for (let id in delta.changes) {
+                if (delta.changes[id] == null) {
+                    delete state[id];
+                } else {
+                    state[id] = delta.changes[id];
+                }
+            }
+            self.navInfo({state: state, version: delta.version});
         };
 
+        self.onStartupComplete = function (event) {
+            self.sync();
+        }
+
+
+        self.onWizardDetails = function () {
+            self.setDefaultDeviceDialogValue($('#mqttPlugWizardForm'))
+        }
+
         self.onSidebarInfo = function (data) {
             //console.log("onSidebarInfo ==>", data)
             self.sidebarInfo(data);
@@ -187,9 +247,12 @@ $(function () {
                 url: BASEURL + "plugin/mqtt_plug/devices",
                 type: "GET",
                 dataType: "json",
+                ifModified: true,
                 contentType: "application/json; charset=UTF-8"
             }).done((res) => {
-                self.devices(res);
+                if (res) {
+                    self.devices(res);
+                }
             }).fail(function (jqXHR, textStatus, errorThrown) {
                 //console.log('error',  jqXHR, textStatus, errorThrown);
                 self.wizardError("Error when get devices")
@@ -207,9 +270,17 @@ $(function () {
             //debugger;
             dialog.find('[name="deviceName"]').val(device.deviceName());
             dialog.find('[name="device_id"]').val(device.id());
+            dialog.find('[name="tags"]').val(device.tags ? (device.tags() || []).join(', ') : '');
 
             dialog.find('[name="stateTopic"]').val(device.stateTopic());
             dialog.find('[name="switchTopic"]').val(device.switchTopic())
+            dialog.find('[name="stateFormat"]').val(device.stateFormat ? device.stateFormat() : 'auto');
+            dialog.find('[name="statePath"]').val(device.statePath ? device.statePath() : 'state');
+            dialog.find('[name="stateRegex"]').val(device.stateRegex ? device.stateRegex() : '');
+            dialog.find('[name="telemetryTopic"]').val(device.telemetryTopic ? device.telemetryTopic() : '');
+            dialog.find('[name="telemetryPath"]').val(device.telemetryPath ? device.telemetryPath() : 'ENERGY.Power');
+            dialog.find('[name="ack_timeout"]').val(device.ackTimeout ? device.ackTimeout() : 5);
+            dialog.find('[name="max_retries"]').val(device.maxRetries ? device.maxRetries() : 2);
 
             dialog.find('[name="on_done"]').prop('checked', device.onDone());
             dialog.find('[name="on_failed"]').prop('checked', device.onFailed());
@@ -226,6 +297,7 @@ $(function () {
             dialog.find('[name="cooldown_hotend"]').val(device.hotendTemp());
 
             self.dialogOnTurnOffModeChange();
+            self.dialogOnStateFormatChange();
 
             dialog.modal();
             self.deviceIdEdit(device.id());
@@ -247,10 +319,18 @@ $(function () {
         self.setDefaultDeviceDialogValue = function (dialog) {
             dialog.find('[name="deviceName"]').val('new Printer');
             dialog.find('[name="device_id"]').val(-1);
+            dialog.find('[name="tags"]').val('');
 
             let baseTopic = self.settings.getLocalData().plugins.mqtt.publish.baseTopic;
             dialog.find('[name="stateTopic"]').val(baseTopic + "device/state")
             dialog.find('[name="switchTopic"]').val(baseTopic + "device/switch")
+            dialog.find('[name="stateFormat"]').val('auto');
+            dialog.find('[name="statePath"]').val('state');
+            dialog.find('[name="stateRegex"]').val('');
+            dialog.find('[name="telemetryTopic"]').val('');
+            dialog.find('[name="telemetryPath"]').val('ENERGY.Power');
+            dialog.find('[name="ack_timeout"]').val(5);
+            dialog.find('[name="max_retries"]').val(2);
 
             dialog.find('[name="on_done"]').prop('checked', true);
             dialog.find('[name="on_failed"]').prop('checked', false);
@@ -269,6 +349,7 @@ $(function () {
             dialog.find('[name="cooldown_hotend"]').val(50);
 
             self.dialogOnTurnOffModeChange();
+            self.dialogOnStateFormatChange();
 
         }
 
@@ -276,8 +357,16 @@ $(function () {
             let device = {
                 deviceName: dialog.find('[name="deviceName"]').val(),
                 id: dialog.find('[name="device_id"]').val(),
+                tags: dialog.find('[name="tags"]').val().split(',').map(t => t.trim()).filter(t => t.length > 0),
                 stateTopic: dialog.find('[name="stateTopic"]').val(),
                 switchTopic: dialog.find('[name="switchTopic"]').val(),
+                stateFormat: dialog.find('[name="stateFormat"]').val(),
+                statePath: dialog.find('[name="statePath"]').val(),
+                stateRegex: dialog.find('[name="stateRegex"]').val(),
+                telemetryTopic: dialog.find('[name="telemetryTopic"]').val(),
+                telemetryPath: dialog.find('[name="telemetryPath"]').val(),
+                ackTimeout: parseInt(dialog.find('[name="ack_timeout"]').val()),
+                maxRetries: parseInt(dialog.find('[name="max_retries"]').val()),
                 // onValue: dialog.find('[name="onValue"]').val(),
                 // offValue: dialog.find('[name="offValue"]').val(),
                 onDone: dialog.find('[name="on_done"]').prop('checked'),
@@ -343,6 +432,14 @@ $(function () {
         }
 
 
+        self.dialogOnStateFormatChange = function () {
+            let dialog = $('#mqtt_plug_device_modal');
+            const stateFormat = dialog.find('[name="stateFormat"]').val();
+
+            $('#plugins_mqtt_plug_grp_state_path')[stateFormat === "json" ? 'show' : 'hide']();
+            $('#plugins_mqtt_plug_grp_state_regex')[stateFormat === "regex" ? 'show' : 'hide']();
+        }
+
         self.deleteDevice = function (device) {
             let deviceId = device.id();
 
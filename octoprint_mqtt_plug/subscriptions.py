@@ -0,0 +1,115 @@
+import contextlib
+import threading
+
+from octoprint_mqtt_plug.topics import TopicIndex
+
+
+class SubscriptionManager:
+    """
+    Reference counted MQTT subscriptions.
+
+    A topic is subscribed when the first user acquires it and unsubscribed
+    when the last one releases it. With ``merge_threshold`` of 2 or more,
+    topics differing by a single level are subscribed as one ``+`` wildcard
+    (e.g. ``tasmota/+/stat/POWER``) once at least that many of them are
+    used; the extra messages it brings are dropped by the local routing.
+    """
+
+    def __init__(self, subscribe, unsubscribe, merge_threshold=0):
+        self._subscribe = subscribe
+        self._unsubscribe = unsubscribe
+        self.merge_threshold = merge_threshold
+        self._lock = threading.RLock()
+        self._refs = dict()
+        self._active = set()
+        self._batch = 0
+
+    @property
+    def active(self):
+        return frozenset(self._active)
+
+    def acquire(self, topic):
+        if not topic:
+            return
+        with self._lock:
+            self._refs[topic] = self._refs.get(topic, 0) + 1
+            if self._refs[topic] == 1:
+                self._sync()
+
+    def release(self, topic):
+        if not topic or topic not in self._refs:
+            return
+        with self._lock:
+            self._refs[topic] -= 1
+            if self._refs[topic] <= 0:
+                del self._refs[topic]
+                self._sync()
+
+    def clear(self):
+        with self._lock:
+            self._refs = dict()
+            self._sync()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Apply the changes made in the block with one subscription update.
+        """
+        with self._lock:
+            self._batch += 1
+            try:
+                yield self
+            finally:
+                self._batch -= 1
+                self._sync()
+
+    def resync(self):
+        with self._lock:
+            self._sync()
+
+    def _sync(self):
+        if self._batch:
+            return
+        desired = self._desired()
+        # subscribe first so that no message is missed while switching
+        # between a wildcard and the plain topics
+        for topic in sorted(desired - self._active):
+            self._subscribe(topic)
+        for topic in sorted(self._active - desired):
+            self._unsubscribe(topic)
+        self._active = desired
+
+    def _desired(self):
+        topics = set(self._refs)
+        if self.merge_threshold < 2:
+            return self._withoutCovered(topics)
+
+        groups = dict()
+        for topic in topics:
+            if TopicIndex.is_wildcard(topic):
+                continue
+            levels = topic.split('/')
+            for i in range(len(levels)):
+                pattern = '/'.join(levels[:i] + ['+'] + levels[i + 1:])
+                groups.setdefault(pattern, set()).add(topic)
+
+        desired = set()
+        covered = set()
+        for pattern, members in sorted(groups.items(), key=lambda item: (-len(item[1]), item[0])):
+            members = members - covered
+            if len(members) < self.merge_threshold:
+                continue
+            desired.add(pattern)
+            covered |= members
+
+        return self._withoutCovered(desired | (topics - covered))
+
+    @staticmethod
+    def _withoutCovered(topics):
+        # plain topics already received through a wildcard subscription
+        wildcards = TopicIndex()
+        for topic in topics:
+            if TopicIndex.is_wildcard(topic):
+                wildcards.add(topic, topic)
+        return set(topic for topic in topics
+                   if TopicIndex.is_wildcard(topic) or not wildcards.match(topic))
@@ -0,0 +1,39 @@
+import collections
+import threading
+
+
+class MessageLog:
+    """
+    Sequence numbers for the plugin messages sent to the UI, and the last
+    ``size`` messages so that a client can catch up after a gap.
+
+    Sequence numbers restart with the server, ``boot`` tells clients when
+    that happened.
+    """
+
+    def __init__(self, boot, size=500):
+        self._lock = threading.Lock()
+        self._messages = collections.deque(maxlen=size)
+        self.boot = boot
+        self.seq = 0
+
+    def append(self, msg_type, payload):
+        with self._lock:
+            self.seq += 1
+            message = dict(type=msg_type, payload=payload, seq=self.seq, boot=self.boot)
+            self._messages.append(message)
+            return message
+
+    def since(self, seq):
+        """
+        Messages sent after ``seq``, or None when some of them are no longer
+        available.
+        """
+        with self._lock:
+            if seq > self.seq:
+                return None
+            if seq == self.seq:
+                return []
+            if not self._messages or self._messages[0]['seq'] > seq + 1:
+                return None
+            return [message for message in self._messages if message['seq'] > seq]
@@ -0,0 +1,199 @@
+import array
+import math
+import threading
+
+# (bucket seconds, bucket count): 1 minute buckets for a day, 10 minutes
+# buckets for a week
+DEFAULT_TIERS = ((60, 1440), (600, 1008))
+DEFAULT_RAW_SIZE = 3600
+
+
+class RingBuffer:
+    """
+    Fixed size columns of doubles, the oldest row is overwritten once full.
+    """
+
+    def __init__(self, size, columns):
+        self.size = size
+        self.columns = tuple(array.array('d', bytes(8 * size)) for _ in range(columns))
+        self.head = 0
+        self.count = 0
+
+    def append(self, *values):
+        for column, value in zip(self.columns, values):
+            column[self.head] = value
+        self.head = (self.head + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def oldest(self):
+        return self.columns[0][(self.head - self.count) % self.size] if self.count else None
+
+    def rows(self, start, end):
+        """
+        Rows whose first column (the time, ascending) is in [start, end).
+        """
+        times = self.columns[0]
+        first = (self.head - self.count) % self.size
+
+        # binary search on the logical (oldest first) positions
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if times[(first + mid) % self.size] < start:
+                lo = mid + 1
+            else:
+                hi = mid
+        for i in range(lo, self.count):
+            index = (first + i) % self.size
+            if times[index] >= end:
+                break
+            yield tuple(column[index] for column in self.columns)
+
+
+class Tier:
+    """
+    Min, max, mean and count of the samples over ``step`` seconds buckets.
+    """
+
+    def __init__(self, step, size):
+        self.step = step
+        self.buckets = RingBuffer(size, 5)
+        self._start = None
+        self._min = self._max = self._sum = 0.0
+        self._count = 0
+
+    def add(self, t, value):
+        start = t - t % self.step
+        if start != self._start:
+            self._close()
+            self._start = start
+            self._min = self._max = self._sum = value
+            self._count = 1
+            return
+        self._min = min(self._min, value)
+        self._max = max(self._max, value)
+        self._sum += value
+        self._count += 1
+
+    def _close(self):
+        if self._count:
+            self.buckets.append(self._start, self._min, self._max, self._sum / self._count, self._count)
+
+    def rows(self, start, end):
+        yield from self.buckets.rows(start, end)
+        # bucket still being filled
+        if self._count and start <= self._start < end:
+            yield self._start, self._min, self._max, self._sum / self._count, self._count
+
+
+class TelemetrySeries:
+    """
+    Telemetry of one device: the last raw samples and downsampled tiers.
+    """
+
+    def __init__(self, raw_size=DEFAULT_RAW_SIZE, tiers=DEFAULT_TIERS):
+        self.raw = RingBuffer(raw_size, 2)
+        self.tiers = [Tier(step, size) for step, size in sorted(tiers)]
+
+    def add(self, t, value):
+        if self.raw.count and t < self.raw.columns[0][(self.raw.head - 1) % self.raw.size]:
+            # keep the columns sorted, late samples are dropped
+            return False
+        self.raw.append(t, value)
+        for tier in self.tiers:
+            tier.add(t, value)
+        return True
+
+    def _buffer(self, source):
+        return self.raw if source is None else source.buckets
+
+    def _step(self, source):
+        return 0 if source is None else source.step
+
+    def _source(self, start, resolution):
+        # None stands for the raw samples, then the tiers finest first
+        sources = [None] + self.tiers
+        covering = [source for source in sources
+                    if self._buffer(source).count < self._buffer(source).size
+                    or self._buffer(source).oldest() <= start]
+        # the coarsest data fine enough for the resolution, else the
+        # finest one going back far enough
+        fine = [source for source in covering if self._step(source) <= resolution]
+        if fine:
+            return fine[-1]
+        if covering:
+            return covering[0]
+        return sources[-1]
+
+    def query(self, start, end, resolution):
+        """
+        Columns ``t``, ``min``, ``max`` and ``mean`` for [start, end) in
+        ``resolution`` seconds buckets starting at multiples of
+        ``resolution`` (like the tiers), empty buckets are left out.
+        """
+        source = self._source(start, resolution)
+        if source is None:
+            rows = ((t, value, value, value, 1) for t, value in self.raw.rows(start, end))
+        else:
+            # from the tier bucket holding start
+            rows = source.rows(start - start % source.step, end)
+
+        res = dict(t=[], min=[], max=[], mean=[], step=max(resolution, self._step(source)))
+        bucket = None
+        total = count = 0
+        for t, low, high, mean, n in rows:
+            b = math.floor(t / resolution) * resolution
+            if b != bucket:
+                if count:
+                    res['mean'].append(total / count)
+                res['t'].append(b)
+                res['min'].append(low)
+                res['max'].append(high)
+                bucket = b
+                total = count = 0
+            else:
+                res['min'][-1] = min(res['min'][-1], low)
+                res['max'][-1] = max(res['max'][-1], high)
+            total += mean * n
+            count += n
+        if count:
+            res['mean'].append(total / count)
+        return res
+
+
+class TelemetryStore:
+    """
+    Telemetry series keyed by device id string, created on first sample.
+    """
+
+    def __init__(self, raw_size=DEFAULT_RAW_SIZE, tiers=DEFAULT_TIERS):
+        self._lock = threading.Lock()
+        self._series = dict()
+        self._raw_size = raw_size
+        self._tiers = tiers
+
+    def __contains__(self, device_id):
+        return device_id in self._series
+
+    def add(self, device_id, t, value) -> bool:
+        with self._lock:
+            series = self._series.get(device_id)
+            if series is None:
+                series = TelemetrySeries(self._raw_size, self._tiers)
+                self._series[device_id] = series
+            return series.add(t, value)
+
+    def query(self, device_id, start, end, resolution):
+        with self._lock:
+            series = self._series.get(device_id)
+            if series is None:
+                return None
+            return series.query(start, end, resolution)
+
+    def remove(self, device_id):
+        with self._lock:
+            self._series.pop(device_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._series = dict()
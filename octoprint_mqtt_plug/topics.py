@@ -0,0 +1,100 @@
+class _TrieNode:
+    __slots__ = ('children', 'values')
+
+    def __init__(self):
+        self.children = dict()
+        self.values = []
+
+
+class TopicIndex:
+    """
+    Map MQTT topics to values.
+
+    Plain topics are kept in a dict, filters containing ``+`` or ``#`` are kept
+    in a trie, so matching a topic does not depend on the number of entries.
+    """
+
+    def __init__(self):
+        self._exact = dict()
+        self._root = _TrieNode()
+        self._wildcards = 0
+
+    @staticmethod
+    def is_wildcard(topic):
+        return '+' in topic or '#' in topic
+
+    def add(self, topic, value):
+        if not topic:
+            return
+        if not self.is_wildcard(topic):
+            self._exact.setdefault(topic, []).append(value)
+            return
+
+        node = self._root
+        for level in topic.split('/'):
+            if level not in node.children:
+                node.children[level] = _TrieNode()
+            node = node.children[level]
+        node.values.append(value)
+        self._wildcards += 1
+
+    def remove(self, topic, value):
+        if not topic:
+            return
+        if not self.is_wildcard(topic):
+            values = self._exact.get(topic)
+            if values is not None and value in values:
+                values.remove(value)
+                if not values:
+                    del self._exact[topic]
+            return
+
+        path = [self._root]
+        levels = topic.split('/')
+        for level in levels:
+            node = path[-1].children.get(level)
+            if node is None:
+                return
+            path.append(node)
+
+        if value not in path[-1].values:
+            return
+        path[-1].values.remove(value)
+        self._wildcards -= 1
+
+        # prune empty branches
+        for i in range(len(levels), 0, -1):
+            node = path[i]
+            if node.values or node.children:
+                break
+            del path[i - 1].children[levels[i - 1]]
+
+    def clear(self):
+        self._exact = dict()
+        self._root = _TrieNode()
+        self._wildcards = 0
+
+    def match(self, topic):
+        values = self._exact.get(topic)
+        if not self._wildcards:
+            return values or ()
+
+        res = list(values) if values else []
+        self._match_node(self._root, topic.split('/'), 0, res)
+        return res
+
+    def _match_node(self, node, levels, i, res):
+        multi = node.children.get('#')
+        if multi is not None:
+            res.extend(multi.values)
+
+        if i == len(levels):
+            res.extend(node.values)
+            return
+
+        child = node.children.get(levels[i])
+        if child is not None:
+            self._match_node(child, levels, i + 1, res)
+        single = node.children.get('+')
+        if single is not None:
+            self._match_node(single, levels, i + 1, res)